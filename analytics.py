@@ -0,0 +1,273 @@
+#!/usr/local/bin/python3
+
+from array import array
+from decimal import Decimal
+
+TOTAL_COLUMNS = ("Operations", "Debit", "Credit", "Max debit", "Max credit")
+CARD_COLUMNS = ("Card", "Currency") + TOTAL_COLUMNS + ("First operation", "Last operation", "Balance")
+MONTH_COLUMNS = ("Card", "Month", "Currency") + TOTAL_COLUMNS + ("Opening balance", "Closing balance")
+PLACE_COLUMNS = ("Place", "Currency") + TOTAL_COLUMNS
+OPERATION_COLUMNS = ("Operation", "Currency") + TOTAL_COLUMNS
+GAP_COLUMNS = ("Card", "Time", "Previous time", "Previous balance", "Balance", "Operation", "Sum", "Currency",
+               "Unexplained")
+
+
+def cents(values):
+    """
+    :param values: list of Decimal or None
+    :return: array of values in hundredths, 0 for None
+    """
+    return array('q', [0 if v is None else round(v * 100) for v in values])
+
+
+def amount(value):
+    """
+    :param value: hundredths as int
+    :return: Decimal with two decimal places, the same as SMS have
+    """
+    return Decimal(value).scaleb(-2)
+
+
+class Codes:
+    """
+    Dictionary encoding of a text column: every distinct value gets an int code
+    """
+
+    def __init__(self, values):
+        """
+        :param values: list of column values
+        """
+        codes = {} # Value -> code
+        setdefault = codes.setdefault
+        self.codes = array('l', [setdefault(v, len(codes)) for v in values])
+        self.values = list(codes) # Code -> value, dicts keep insertion order
+
+    def __getitem__(self, code):
+        return self.values[code]
+
+
+class Columns:
+    """
+    Operations as columns: text fields are dictionary encoded, sums and balances are integers in hundredths,
+    so aggregates are exact and 1M operations take some tens of MB. Columns are built one at a time
+    with comprehensions, not record by record
+    """
+
+    def __init__(self, oper):
+        """
+        :param oper: list of records.Operation
+        """
+        self.records = oper
+        times = [o.time for o in oper]
+        sums, bals = [o.sum for o in oper], [o.bal for o in oper]
+
+        self.card = Codes([o.card if o.bank is None else o.bank + " " + str(o.card) for o in oper])
+        self.place = Codes([o.place or "" for o in oper])
+        self.oper = Codes([o.oper or "" for o in oper])
+        self.currency = Codes([o.currency or "" for o in oper])
+        self.cards, self.places, self.opers, self.currencies = (self.card.codes, self.place.codes, self.oper.codes,
+                                                                self.currency.codes)
+        self.months = array('l', [t.year * 12 + t.month - 1 for t in times]) # year * 12 + month - 1
+        self.times = array('d', [t.timestamp() for t in times]) # POSIX time, orders operations of a card
+        self.sums, self.bals = cents(sums), cents(bals)
+        self.comissions = cents([o.comission if o.commcurr in (None, o.currency) else None for o in oper])
+        self.has_sum = bytearray([v is not None for v in sums])
+        self.has_bal = bytearray([v is not None for v in bals])
+
+    def __len__(self):
+        return len(self.sums)
+
+    def order(self):
+        """
+        :return: array of row numbers ordered by card and time
+        """
+        by_time = sorted(range(len(self)), key=self.times.__getitem__)
+        return array('l', sorted(by_time, key=self.cards.__getitem__)) # Sort is stable, time order stays
+
+
+def aggregate(keys, sums, has_sum, credit):
+    """
+    Grouped count, debit and credit totals and the largest debit and credit. SMS sums have no sign,
+    so debits and credits are summed apart, one total of both means nothing
+    :param keys: iterable of hashable group keys, one per row
+    :param sums: array of sums
+    :param has_sum: bytearray, rows without sum are counted but not summed
+    :param credit: bytearray, 1 for credit and 0 for debit row (see credits)
+    :return: dict key -> list [count, debit, credit, max debit, max credit], max is None if there is no such row
+    """
+    groups = {}
+    for key, value, present, side in zip(keys, sums, has_sum, credit):
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = [0, 0, 0, None, None]
+        group[0] += 1
+        if present:
+            group[1 + side] += value
+            if group[3 + side] is None or value > group[3 + side]:
+                group[3 + side] = value
+    return groups
+
+
+def totals(group):
+    """
+    :param group: list [count, debit, credit, max debit, max credit] made by aggregate
+    :return: tuple in TOTAL_COLUMNS order with amounts as Decimal
+    """
+    return (group[0],) + tuple(amount(v) if v is not None else None for v in group[1:])
+
+
+def month_name(month):
+    """
+    :param month: year * 12 + month - 1
+    :return: 'YYYY-MM'
+    """
+    return "%04d-%02d" % (month // 12, month % 12 + 1)
+
+
+def card_currencies(cols):
+    """
+    Currency of every card account: the one most of its operations have, balance is written in it
+    :param cols: Columns object
+    :return: dict card code -> currency code
+    """
+    counts = {}
+    for key in zip(cols.cards, cols.currencies):
+        counts[key] = counts.get(key, 0) + 1
+    main = {}
+    for (card, currency), count in counts.items():
+        if card not in main or count > counts[(card, main[card])]:
+            main[card] = currency
+    return main
+
+
+def balances(cols, order):
+    """
+    Running balances of cards, operations are walked in card and time order
+    :param cols: Columns object
+    :param order: row numbers ordered by card and time
+    :return: tuple of dicts (card code -> last balance, (card code, month) -> balance before the month,
+            (card code, month) -> last balance in the month), balances are in hundredths
+    """
+    last, opening, closing = {}, {}, {}
+    for n in order:
+        if not cols.has_bal[n]:
+            continue
+        card, month, bal = cols.cards[n], cols.months[n], cols.bals[n]
+        if (card, month) not in closing and card in last: # Balance the month starts with
+            opening[(card, month)] = last[card]
+        last[card] = closing[(card, month)] = bal
+    return last, opening, closing
+
+
+def balance_steps(cols, order):
+    """
+    Balance changes made by operations: balance of an operation with sum in the card's currency less the balance
+    of the operation before it. Operations in other currencies than the card's one only carry the balance over
+    :param cols: Columns object
+    :param order: row numbers ordered by card and time
+    :return: generator of tuples (previous row, row, balance change in hundredths)
+    """
+    main = card_currencies(cols)
+    cards, currencies, bals = cols.cards, cols.currencies, cols.bals
+    p = None # Last row with balance, rows of a card follow each other in order
+    for n in order:
+        if not cols.has_bal[n]:
+            continue
+        card = cards[n]
+        if p is not None and cards[p] == card and cols.has_sum[n] and currencies[n] == main[card]:
+            yield p, n, bals[n] - bals[p]
+        p = n
+
+
+def credits(cols, order):
+    """
+    Direction of every operation: balance goes up by the sum for credit and down by the sum (with comission)
+    for debit. Operations whose balance change is unknown (first of the card, without balance, in other currency,
+    after missed SMS) take the direction most operations with the same name have, debit if there are none
+    :param cols: Columns object
+    :param order: row numbers ordered by card and time
+    :return: bytearray, 1 for credit and 0 for debit row
+    """
+    sums, comissions = cols.sums, cols.comissions
+    known = {} # Row -> direction
+    for p, n, delta in balance_steps(cols, order):
+        value = sums[n]
+        if value and delta == value:
+            known[n] = 1
+        elif delta == -value or delta == -value - comissions[n]:
+            known[n] = 0
+    votes = [[0, 0] for _ in cols.oper.values] # Operation code -> [debits, credits]
+    for n, side in known.items():
+        votes[cols.opers[n]][side] += 1
+    usual = bytearray([up > down for down, up in votes])
+    return bytearray([known[n] if n in known else usual[code] for n, code in enumerate(cols.opers)])
+
+
+def balance_gaps(cols, order):
+    """
+    Places where the balance doesn't follow from the previous one: balance change must be the sum
+    (with comission for debit) of the operation, anything else means missed SMS
+    :param cols: Columns object
+    :param order: row numbers ordered by card and time
+    :return: list of rows in GAP_COLUMNS order
+    """
+    sums, comissions = cols.sums, cols.comissions
+    gaps = []
+    for p, n, delta in balance_steps(cols, order):
+        value = sums[n]
+        if delta != value and delta != -value and delta != -value - comissions[n]:
+            o, prev = cols.records[n], cols.records[p]
+            gaps.append((cols.card[cols.cards[n]], o.time, prev.time, prev.bal, o.bal, o.oper, o.sum, o.currency,
+                         amount(min(delta - value, delta + value, key=abs))))
+    return gaps
+
+
+def summary_tables(oper):
+    """
+    Summary tables of operations: totals per card, per card and month (with running balances), per place and
+    per operation, then balance gaps (missed SMS)
+    :param oper: list of records.Operation
+    :return: list of tuples (title, columns, rows) as writers.output_tables makes, empty if there are no operations
+    """
+    if not oper:
+        return []
+    cols = Columns(oper)
+    order = cols.order()
+    last, opening, closing = balances(cols, order)
+    start, end = {}, {} # Card code -> position of its first and last operation in order
+    for position, n in enumerate(order):
+        start.setdefault(cols.cards[n], position)
+        end[cols.cards[n]] = position
+    currency, card, place, op = cols.currency.values, cols.card.values, cols.place.values, cols.oper.values
+    credit = credits(cols, order)
+
+    by_card = aggregate(zip(cols.cards, cols.currencies), cols.sums, cols.has_sum, credit)
+    card_rows = [(card[c], currency[cur]) + totals(group) +
+                 (cols.records[order[start[c]]].time, cols.records[order[end[c]]].time,
+                  amount(last[c]) if c in last else None)
+                 for (c, cur), group in sorted(by_card.items(), key=lambda i: (card[i[0][0]], currency[i[0][1]]))]
+
+    by_month = aggregate(zip(cols.cards, cols.months, cols.currencies), cols.sums, cols.has_sum, credit)
+    month_rows = [(card[c], month_name(m), currency[cur]) + totals(group) +
+                  (amount(opening[(c, m)]) if (c, m) in opening else None,
+                   amount(closing[(c, m)]) if (c, m) in closing else None)
+                  for (c, m, cur), group in sorted(by_month.items(), key=lambda i: (card[i[0][0]], i[0][1],
+                                                                                    currency[i[0][2]]))]
+
+    by_place = aggregate(zip(cols.places, cols.currencies), cols.sums, cols.has_sum, credit)
+    place_rows = [(place[p], currency[cur]) + totals(group)
+                  for (p, cur), group in sorted(by_place.items(), key=lambda i: (-i[1][1], -i[1][2]))]
+
+    by_oper = aggregate(zip(cols.opers, cols.currencies), cols.sums, cols.has_sum, credit)
+    oper_rows = [(op[o], currency[cur]) + totals(group)
+                 for (o, cur), group in sorted(by_oper.items(), key=lambda i: (-i[1][1], -i[1][2]))]
+
+    return [("Summary cards", CARD_COLUMNS, iter(card_rows)),
+            ("Summary months", MONTH_COLUMNS, iter(month_rows)),
+            ("Summary places", PLACE_COLUMNS, iter(place_rows)),
+            ("Summary operations", OPERATION_COLUMNS, iter(oper_rows)),
+            ("Balance gaps", GAP_COLUMNS, iter(balance_gaps(cols, order)))]
+
+
+if __name__ == "__main__":
+    print("This module is for import only")
@@ -0,0 +1,166 @@
+#!/usr/local/bin/python3
+
+import importlib, pprint
+
+ENTRY_POINTS = 'sbermaster.banks' # Entry point group of bank modules from installed packages
+
+BANKS = { # Bank name -> module name, modules are imported on first use
+    'sberbank': 'sberbank',
+    'vesta': 'vestabank',
+    'vtb': 'vtbbank',
+}
+
+
+def register(name, module):
+    """
+    Register bank module. The module must have stop_words, rules (RuleTable), parse_sms_list(trans_list, warn)
+    and SEARCH (default IMAP search string); match_transfers(oper, trf, unique) if transfers come in SMS
+    of their own, SENDERS (strings found in From header of bank SMS) to route messages of several banks,
+    SERVER_EXCLUDE (lowercase phrases of noise SMS that server SEARCH may drop before fetch; server may not
+    accept the keys, so stop_words must exclude them too, they still check every message)
+    :param name: bank name for --bank option
+    :param module: module name
+    """
+    BANKS[name] = module
+
+
+def entry_points():
+    """
+    Bank modules of installed packages, declared as entry_points={'sbermaster.banks': ['name = package.module']}
+    :return: dict bank name -> module name
+    """
+    from importlib import metadata
+    try:
+        found = metadata.entry_points(group=ENTRY_POINTS)
+    except TypeError: # Python < 3.10
+        found = metadata.entry_points().get(ENTRY_POINTS, ())
+    return {ep.name: ep.value.partition(':')[0].strip() for ep in found}
+
+
+def names():
+    """
+    :return: sorted list of known bank names, installed packages included
+    """
+    return sorted(set(BANKS) | set(entry_points()))
+
+
+def load(name):
+    """
+    Import bank module, installed packages are looked up only for names that are not registered
+    :param name: bank name
+    :return: bank module
+    :raise: ValueError if bank is unknown
+    """
+    if name not in BANKS:
+        for bank, module in entry_points().items():
+            BANKS.setdefault(bank, module)
+    if name not in BANKS:
+        raise ValueError("Unknown bank " + name + ", use " + " | ".join(names()))
+    return importlib.import_module(BANKS[name])
+
+
+def search_string(modules):
+    """
+    Search string matching SMS of any of the banks
+    :param modules: list of bank modules
+    :return: search string in IMAP format
+    """
+    if len(modules) == 1:
+        return modules[0].SEARCH
+    return "OR (" + modules[0].SEARCH + ") (" + search_string(modules[1:]) + ")"
+
+
+def senders(modules):
+    """
+    Senders of SMS of any of the banks
+    :param modules: list of bank modules
+    :return: tuple of strings found in From header or SMS address, empty if a bank has no SENDERS (any sender)
+    """
+    if not all(getattr(m, 'SENDERS', ()) for m in modules):
+        return ()
+    return tuple(s for m in modules for s in m.SENDERS)
+
+
+def server_exclude(modules):
+    """
+    Phrases of messages that server SEARCH may drop. With several banks only phrases common to all of them
+    are used, noise of one bank can be an operation of another
+    :param modules: list of bank modules
+    :return: tuple of lowercase phrases
+    """
+    phrases = [getattr(m, 'SERVER_EXCLUDE', ()) for m in modules]
+    return tuple(p for p in phrases[0] if all(p in other for other in phrases[1:]))
+
+
+def candidates(transaction, modules):
+    """
+    Banks to try for the message, banks of message sender go first
+    :param transaction: dict with 'body' key, 'sender' key if From header was fetched
+    :param modules: list of bank modules
+    :return: list of bank modules
+    """
+    sender = transaction.get('sender')
+    if not sender:
+        return modules
+    own = [m for m in modules if any(s in sender for s in getattr(m, 'SENDERS', ()))]
+    return own + [m for m in modules if m not in own]
+
+
+def parse_sms_list(trans_list, modules, warn=False):
+    """
+    Parse SMS of one or several banks. With several banks every message goes to the first bank
+    which stop words pass it and rules match it, banks of message sender are tried first
+    :param trans_list: list of transactions as dicts with 'time' and 'body' keys
+    :param modules: list of bank modules
+    :param warn: print warnings
+    :return: tuple of (operations, transfers), records have bank name (of rule table) if there are several banks
+    """
+    if len(modules) == 1:
+        return modules[0].parse_sms_list(trans_list, warn)
+
+    oper = []  # Card operations
+    trf = []  # Money transfers
+
+    for transaction in trans_list:
+        try:
+            for module in candidates(transaction, modules):
+                if not module.stop_words(transaction):
+                    continue
+                kind, values = module.rules.process(transaction)
+                if kind is None:
+                    continue
+                values.bank = module.rules.bank
+                (oper if kind == 'oper' else trf).append(values)
+                break
+            else:
+                if warn:
+                    print("WARNING: unknown transaction")
+                    pprint.pprint(transaction)
+        except:
+            print("ERROR: unable to process")
+            pprint.pprint(transaction)
+
+    return oper, trf
+
+
+def match_transfers(oper, trf, modules, unique=False):
+    """
+    Attach transfers to operations with match_transfers of the banks which have it
+    :param oper: list of operations
+    :param trf: list of transfers
+    :param modules: list of bank modules
+    :param unique: attach every transfer to one operation at most
+    :return: None
+    """
+    for module in modules:
+        if not hasattr(module, 'match_transfers'):
+            continue
+        if len(modules) == 1:
+            module.match_transfers(oper, trf, unique)
+        else:
+            bank = module.rules.bank
+            module.match_transfers([o for o in oper if o.bank == bank], [t for t in trf if t.bank == bank], unique)
+
+
+if __name__ == "__main__":
+    print("This module is for import only")
@@ -0,0 +1,621 @@
+#!/usr/local/bin/python3
+
+import argparse, imaplib, json, os, random, re, resource, select, socketserver, subprocess, sys, tempfile, threading, time
+import email.utils
+from email.message import EmailMessage
+from datetime import datetime, timedelta
+from dateutil import tz
+
+import sbermaster, banks
+
+STAGES = ('startup', 'imap', 'stop_words', 'parse', 'transfers', 'save')
+STARTUP_RUNS = 5 # cold starts per measurement, the fastest one counts
+
+NAMES = ('ИВАН ИВАНОВИЧ И.', 'МАРИЯ ПЕТРОВНА С.', 'ОЛЕГ НИКОЛАЕВИЧ К.', 'АННА СЕРГЕЕВНА Б.')
+PLACES = ('PYATEROCHKA 1234', 'MAGNIT MM ALBATROS', 'YANDEX.TAXI', 'IP SOROKIN E.A. SMT', 'AZS 17', 'APTEKA 36.6')
+COMMENTS = ('на обед', 'за билеты', 'долг', 'подарок')
+NOISE = ('Привет, как дела?', 'Ваш заказ доставлен', 'Code: 1234', 'Скидка 10% только сегодня', 'ok')
+
+
+def sberbank_sms(rnd, t):
+    """
+    Random Sberbank SMS texts sent at time t, transfer pairs come together
+    :param rnd: random.Random object
+    :param t: datetime of SMS
+    :return: list of SMS texts
+    """
+    card = rnd.choice(('VISA1234', 'ECMC5678', 'MIR-0042'))
+    amount = rnd.randint(1, 30000)
+    bal = "%d.%02d" % (rnd.randint(0, 200000), rnd.randint(0, 99))
+    hm = t.strftime("%H:%M")
+    dmy = t.strftime("%d.%m.%y")
+    name = rnd.choice(NAMES)
+    kind = rnd.randrange(12)
+    if kind < 4:
+        return ["%s %s Покупка %dр %s Баланс: %sр" % (card, hm, amount, rnd.choice(PLACES), bal)]
+    if kind == 4:
+        return ["%s %s %s покупка %d.%02dр %s Баланс: %sр" % (card, dmy, hm, amount, rnd.randint(0, 99),
+                                                              rnd.choice(PLACES), bal)]
+    if kind == 5:
+        return ["%s %s выдача %dр ATM %d с комиссией %dр Баланс: %sр" % (card, hm, amount, rnd.randint(1, 999),
+                                                                         rnd.randint(1, 100), bal)]
+    if kind == 6:
+        return ["%s %s оплата Мобильного банка за %s-%s 60р Баланс: %sр" % (card, dmy, t.strftime("%d/%m/%Y"),
+                                                                              t.strftime("%d/%m/%Y"), bal)]
+    if kind == 7:
+        return ['Сбербанк Онлайн. %s перевел(а) вам %d.00 RUB. Сообщение: "%s"' % (name, amount, rnd.choice(COMMENTS)),
+                "%s %s зачисление %dр Баланс: %sр" % (card, hm, amount, bal)]
+    if kind == 8:
+        return ["%s: %s %s зачисление %dр от отправителя %s" % (card, dmy, hm, amount, name),
+                "%s %s зачисление %dр Баланс: %sр" % (card, hm, amount, bal)]
+    if kind == 9:
+        return ['%s %s зачисление %dр от %s\nБаланс: %sр\nСообщение: "%s"' % (card, hm, amount, name, bal,
+                                                                            rnd.choice(COMMENTS))]
+    if kind == 10:
+        return ['Перевод %dр от %s\nБаланс %s: %sр\nСообщение: "%s"' % (amount, name, card, bal,
+                                                                       rnd.choice(COMMENTS))]
+    return [rnd.choice(("Пароль для входа в Сбербанк Онлайн: %05d. Никому не сообщайте код" % rnd.randint(0, 99999),
+                        "%s %s Покупка %dр %s не выполнена, недостаточно средств" % (card, hm, amount,
+                                                                                      rnd.choice(PLACES)),
+                        rnd.choice(NOISE)))]
+
+
+def vtb_sms(rnd, t):
+    """
+    Random VTB SMS texts, see sberbank_sms
+    """
+    card = "%04d" % rnd.randint(0, 9999)
+    amount = "%d.%02d" % (rnd.randint(1, 30000), rnd.randint(0, 99))
+    bal = "%d.%02d" % (rnd.randint(0, 200000), rnd.randint(0, 99))
+    kind = rnd.randrange(5)
+    if kind < 2:
+        return ["Karta *%s: Oplata %s RUB; %s;%s,dostupno %s RUB" % (card, amount, rnd.choice(PLACES),
+                                                                    t.strftime("%d.%m.%Y %H:%M"), bal)]
+    if kind == 2:
+        return ["Karta *%s: Zachislenie %s RUB; dostupno %s RUB. VTB" % (card, amount, bal)]
+    if kind == 3:
+        return ["Oplata %sRUB Karta*%s %s Balans %sRUB %s" % (amount, card, rnd.choice(PLACES), bal,
+                                                             t.strftime("%H:%M"))]
+    return [rnd.choice(("Karta *%s: vhod v internet-bank" % card,
+                        "Parol: %04d. Nikomu ne soobshchayte" % rnd.randint(0, 9999), rnd.choice(NOISE)))]
+
+
+def vesta_sms(rnd, t):
+    """
+    Random VestaBank SMS texts, see sberbank_sms
+    """
+    card = "%04d" % rnd.randint(0, 9999)
+    amount = "%d.%02d" % (rnd.randint(1, 30000), rnd.randint(0, 99))
+    bal = "%d.%02d" % (rnd.randint(0, 200000), rnd.randint(0, 99))
+    dt = t.strftime("%d.%m.%Y %H:%M")
+    kind = rnd.randrange(4)
+    if kind < 2:
+        return ["Karta %s: %s, Pokupka %s RUB, %s. Dostupno %s RUB." % (card, dt, amount, rnd.choice(PLACES), bal)]
+    if kind == 2:
+        return ["Karta %s: %s, Snyatie nalichnyh %s RUB. komissiya D%d.00 RUB. ATM %d. Dostupno %s RUB."
+                % (card, dt, amount, rnd.randint(1, 100), rnd.randint(1, 999), bal)]
+    return [rnd.choice(("Karta %s: vhod v internet-bank" % card,
+                        "Вход в VestaBank, пароль %04d" % rnd.randint(0, 9999), rnd.choice(NOISE)))]
+
+
+GENERATORS = {'sberbank': sberbank_sms, 'vtb': vtb_sms, 'vesta': vesta_sms}
+
+
+def make_corpus(bank, size, seed=1):
+    """
+    Synthetic SMS of one bank
+    :param bank: bank name, one of BANKS keys
+    :param size: number of messages
+    :param seed: random seed, the same seed gives the same corpus
+    :return: list of dicts {'time', 'body'} in time order
+    """
+    rnd = random.Random(seed)
+    t = datetime(2018, 3, 1, 9, 0, tzinfo=tz.tzoffset(None, 10800))
+    sms_list = []
+    while len(sms_list) < size:
+        t += timedelta(seconds=rnd.randint(30, 4000))
+        for i, body in enumerate(GENERATORS[bank](rnd, t)):
+            sms_list.append({'time': t + timedelta(seconds=i * rnd.randint(1, 60)), 'body': body})
+    return sms_list[:size]
+
+
+# Pieces inserted into fuzzed SMS: separators and key words of every format, so fields hold text of other fields
+FUZZ_PIECES = (' ', '.', ',', ';', ':', '"', '(', ')', '*', '\n', '\r\n', '1', '12', '1.5', '12:30', '01.03.18',
+               '23/03/2018', 'р', 'RUB', ' от ', ' от отправителя ', 'Баланс: ', ' Баланс ', ' с комиссией 5р',
+               ' перевел', 'Сообщение: "', ' Karta*12', ' Balans ', 'dostupno 1 ', '; dostupno ', ',dostupno ',
+               'komissiya D1 ', 'Dostupno ', '. ', ', ', 'ИВАН И.', ' 1р', 'Karta *1: ', '1 RUB.', '\nБаланс: 1р',
+               'VISA1234 ')
+
+# Near miss SMS of growing length: regex tries every split of repeated part before it fails
+PATHOLOGICAL = {
+    'sberbank': {
+        'receivenew2': lambda k: 'Перевод 1' + ' 1р от' * k + '\nБаланс X: 1',
+        'receivenew': lambda k: 'a 1 ' + '1 1 от ' * k + '\nБаланс: x',
+        'purchase': lambda k: 'a 1:1 ' + '1 1 ' * k + ' Баланс: x',
+        'mobilebank': lambda k: 'a 1.1.1 ' + '1 1 ' * k + ' Баланс: x',
+        'transfer': lambda k: 'Сбербанк Онлайн. ' + 'a перевел 1 ' * k,
+        'receive': lambda k: 'a 1 ' + '1 1 от отправителя ' * k + '\n',
+    },
+    'vtb': {
+        'purchase': lambda k: 'Karta *1: a 1 ' + 'b;' * k + 'dostupno 1 RUB.x',
+        'refund': lambda k: 'Karta *1: a 1 ' + 'b; dostupno 1 x' * k,
+        'purchase2': lambda k: 'a 1' + ' Karta*1 b' * k + ' Balans 1 x',
+    },
+    'vesta': {
+        'purchase': lambda k: 'Karta 1: a, b 1 ' + 'c. ' * k + 'Dostupno 1 x',
+    },
+}
+
+
+def fuzz_corpus(bank, size, seed=1):
+    """
+    SMS of the bank with random pieces inserted, spans deleted and repeated, line ends changed to CRLF
+    :param bank: bank name, one of BANKS keys
+    :param size: number of messages
+    :param seed: random seed, the same seed gives the same corpus
+    :return: list of SMS texts, every fifth one is left as generated, every fourth one has random pieces
+            after its start
+    """
+    rnd = random.Random(seed)
+    corpus = []
+    for n, sms in enumerate(make_corpus(bank, size, seed)):
+        body = sms['body']
+        if n % 4 == 3:
+            body = body[:rnd.randrange(len(body))] + "".join(rnd.choice(FUZZ_PIECES) for i in range(rnd.randint(1, 12)))
+        for i in range(rnd.randrange(4) if n % 5 else 0):
+            pos, span = rnd.randrange(len(body) + 1), rnd.randint(1, 6)
+            mutation = rnd.randrange(3)
+            if mutation == 0:
+                body = body[:pos] + rnd.choice(FUZZ_PIECES) + body[pos:]
+            elif mutation == 1:
+                body = body[:pos] + body[pos + span:]
+            else:
+                body = body[:pos] + body[pos:pos + span] * rnd.randint(2, 20) + body[pos:]
+        if rnd.randrange(10) == 0:
+            body = body.replace('\n', '\r\n')
+        corpus.append(body)
+    return corpus
+
+
+def check_parsers(bank, corpus):
+    """
+    Match every message with every rule which has token parser, both with the parser and the regex of the rule
+    :param bank: bank name
+    :param corpus: list of SMS texts
+    :return: tuple (number of regex matches, list of (rule name, body, regex groups, parser groups) that differ)
+    """
+    matched, differ = 0, []
+    for rule in banks.load(bank).rules.rules:
+        if rule.parse == rule.regex.match:
+            continue
+        for body in corpus:
+            expected, values = rule.regex.match(body), rule.parse(body)
+            expected, values = expected and expected.groups(), values and values.groups()
+            matched += expected is not None
+            if expected != values:
+                differ.append((rule.name, body, expected, values))
+    return matched, differ
+
+
+def pathological(bank, repeats):
+    """
+    Worst case time of regex and token parser of every rule on near miss SMS
+    :param bank: bank name
+    :param repeats: list of repeat counts of PATHOLOGICAL messages
+    :return: list of tuples (rule name, message length, regex seconds, parser seconds)
+    """
+    results = []
+    for rule in banks.load(bank).rules.rules:
+        make = PATHOLOGICAL.get(bank, {}).get(rule.name)
+        for k in repeats if make else ():
+            body = make(k)
+            times = []
+            for parse in (rule.regex.match, rule.parse):
+                best = None
+                for run in range(3): # The fastest run counts
+                    start = time.perf_counter()
+                    parse(body)
+                    best = min(best or 1e9, time.perf_counter() - start)
+                times.append(best)
+            results.append((rule.name, len(body), times[0], times[1]))
+    return results
+
+
+def raw_message(sms, uid, sender="900"):
+    """
+    Message as it is stored by SMS Backup+
+    :param sms: dict {'time', 'body'}
+    :param uid: message number
+    :param sender: SMS sender
+    :return: raw message as bytes
+    """
+    return ("From: %s <%s@unknown.email>\r\nTo: me@gmail.com\r\nSubject: SMS with %s\r\n"
+            "Date: %s\r\nMessage-ID: <%d@sms-backup-plus.local>\r\nMIME-Version: 1.0\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: 8bit\r\n\r\n%s"
+            % (sender, sender, sender, email.utils.format_datetime(sms['time']), uid,
+               sms['body'].replace("\n", "\r\n"))).encode('utf-8')
+
+
+def mime_forms(sms, uid):
+    """
+    The same SMS as messages of other mailers: base64 and quoted-printable single part (decoded without
+    MIME parser), multipart with HTML copy and attachment (MIME parser)
+    :param sms: dict {'time', 'body'}
+    :param uid: message number
+    :return: dict form name -> raw message as bytes
+    """
+    forms = {}
+    for cte in ('base64', 'quoted-printable'):
+        msg = EmailMessage()
+        msg['From'], msg['Date'] = "900", email.utils.format_datetime(sms['time'])
+        msg.set_content(sms['body'], cte=cte)
+        forms[cte] = msg.as_bytes()
+    msg = EmailMessage()
+    msg['From'], msg['Date'] = "900", email.utils.format_datetime(sms['time'])
+    msg['Message-ID'] = "<%d@mailer.local>" % uid
+    msg.set_content(sms['body'])
+    msg.add_alternative("<p>" + sms['body'] + "</p>", subtype='html')
+    msg.add_attachment(b"\x89PNG\r\n", maintype='image', subtype='png', filename="sms.png")
+    forms['multipart'] = msg.as_bytes()
+    return forms
+
+
+def check_decoding(corpus):
+    """
+    Decode every SMS of corpus in every form of mime_forms, each must give the SMS back
+    (line ends aside, mailers write their own)
+    :param corpus: list of dicts {'time', 'body'}
+    :return: tuple (number of messages decoded, list of (form name, SMS, decoded records) that differ)
+    """
+    decoded, differ = 0, []
+    for uid, sms in enumerate(corpus, 1):
+        for name, raw in mime_forms(sms, uid).items():
+            records = sbermaster.decode_message(raw)
+            decoded += 1
+            if [(r['time'], r['body'].replace("\r\n", "\n").rstrip("\n")) for r in records] != \
+                    [(sms['time'], sms['body'].rstrip("\n"))]:
+                differ.append((name, sms, records))
+    return decoded, differ
+
+
+class IMAPStubHandler(socketserver.StreamRequestHandler):
+    """
+    Minimal IMAP4rev1 server side: LOGIN, SELECT, UID SEARCH (CHARSET, ALL, 'UID n:*', FROM, any of FROM keys
+    matches, NOT BODY and X-GM-RAW '-"phrase"' exclusions, literals), UID FETCH of RFC822 or header fields
+    and text, IDLE, CLOSE, LOGOUT
+    """
+    messages = ()
+    # First search keys the stub knows, anything else (as charset name without CHARSET) is BAD as real servers say
+    SEARCH_KEYS = (b"(", b"ALL", b"UID", b"FROM", b"NOT", b"OR", b"SINCE", b"X-GM-RAW")
+
+    def reply(self, *lines):
+        self.wfile.write(b"".join(lines))
+
+    def handle(self):
+        self.reply(b"* OK [CAPABILITY ", self.server.capabilities, b"] stub ready\r\n")
+        for line in self.rfile:
+            literal = re.search(rb'\{([0-9]+)\}\r\n$', line)
+            while literal: # Literal is read after continuation and put in line as quoted string
+                self.reply(b"+ go\r\n")
+                value = self.rfile.read(int(literal.group(1)))
+                line = line[:literal.start()] + b'"' + value.replace(b'"', b'\\"') + b'"' + self.rfile.readline()
+                literal = re.search(rb'\{([0-9]+)\}\r\n$', line)
+            tag, command, args = (line.rstrip(b"\r\n").split(b" ", 2) + [b"", b""])[:3]
+            command = command.upper()
+            if command == b"UID":
+                command, args = (args.split(b" ", 1) + [b""])[:2]
+                command = b"UID " + command.upper()
+
+            if command == b"CAPABILITY":
+                self.reply(b"* CAPABILITY ", self.server.capabilities, b"\r\n", tag, b" OK done\r\n")
+            elif command in (b"LOGIN", b"NOOP", b"CLOSE"):
+                self.reply(tag, b" OK done\r\n")
+            elif command in (b"SELECT", b"EXAMINE"):
+                folder = self.server.folders.get(args.strip(b'"').decode())
+                if folder is None:
+                    self.reply(tag, b" NO no such folder\r\n")
+                    continue
+                self.messages = folder
+                self.reply(b"* %d EXISTS\r\n* OK [UIDVALIDITY %d] ok\r\n* OK [UIDNEXT %d] ok\r\n"
+                           % (len(self.messages), self.server.uidvalidity, len(self.messages) + 1),
+                           tag, b" OK [READ-WRITE] done\r\n")
+            elif command == b"UID SEARCH":
+                criteria = re.sub(rb'^CHARSET \S+ ', b"", args, flags=re.IGNORECASE)
+                if not criteria.upper().startswith(self.SEARCH_KEYS):
+                    self.reply(tag, b" BAD invalid search criteria\r\n")
+                    continue
+                self.reply(b"* SEARCH ", b" ".join(b"%d" % u for u in self.search(criteria)), b"\r\n",
+                           tag, b" OK done\r\n")
+            elif command == b"UID FETCH":
+                mset, items = args.split(b" ", 1)
+                self.fetch(mset, items)
+                self.reply(tag, b" OK done\r\n")
+            elif command == b"IDLE":
+                self.reply(b"+ idling\r\n")
+                count, generation = len(self.messages), self.server.generation
+                while not select.select([self.connection], [], [], 0.05)[0]: # Until DONE comes
+                    if self.server.generation != generation: # Connection is dropped
+                        return
+                    if len(self.messages) != count:
+                        count = len(self.messages)
+                        self.reply(b"* %d EXISTS\r\n" % count)
+                self.rfile.readline()
+                self.reply(tag, b" OK idle done\r\n")
+            elif command == b"LOGOUT":
+                self.reply(b"* BYE\r\n", tag, b" OK done\r\n")
+                return
+            else:
+                self.reply(tag, b" BAD unknown command\r\n")
+
+    def search(self, criteria):
+        last = len(self.messages)
+        above = re.search(rb'UID ([0-9]+):\*', criteria)
+        uids = (range(int(above.group(1)), last + 1) or [last]) if above else range(1, last + 1)
+        senders = re.findall(rb'FROM ([^\s()]+)', criteria)
+        if senders:
+            uids = [u for u in uids if any(s.lower() in self.messages[u - 1].split(b"\r\n", 1)[0].lower()
+                                           for s in senders)]
+        excluded = [re.sub(rb'\\(.)', rb'\1', p).decode('utf-8').lower()
+                    for groups in re.findall(rb'NOT BODY "((?:[^"\\]|\\.)*)"|-\\?"([^"\\]*)\\?"', criteria)
+                    for p in groups if p]
+        if excluded:
+            uids = [u for u in uids if not any(p in self.messages[u - 1].partition(b"\r\n\r\n")[2].decode('utf-8')
+                                               .lower() for p in excluded)]
+        return uids
+
+    def fetch(self, mset, items):
+        last = len(self.messages)
+        for part in mset.split(b","):
+            first, colon, end = part.partition(b":")
+            end = end if colon else first
+            end = last if end == b"*" else min(int(end), last)
+            for uid in range(int(first), end + 1):
+                msg = self.messages[uid - 1]
+                if b"RFC822" in items:
+                    self.reply(b"* %d FETCH (UID %d RFC822 {%d}\r\n" % (uid, uid, len(msg)), msg, b")\r\n")
+                    continue
+                head, sep, text = msg.partition(b"\r\n\r\n")
+                names = re.search(rb'HEADER\.FIELDS \(([^)]*)\)', items).group(1)
+                wanted = names.lower().split()
+                fields = b"".join(line + b"\r\n" for line in head.split(b"\r\n")
+                                  if line.split(b":")[0].lower() in wanted) + b"\r\n"
+                self.reply(b"* %d FETCH (UID %d BODY[HEADER.FIELDS (%s)] {%d}\r\n" % (uid, uid, names, len(fields)),
+                           fields, b" BODY[TEXT] {%d}\r\n" % len(text), text, b")\r\n")
+
+
+class IMAPStub(socketserver.ThreadingTCPServer):
+    """
+    Local IMAP server running in a thread, for benchmarks without network
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, messages, uidvalidity=1, capabilities=b"IMAP4rev1 IDLE"):
+        """
+        :param messages: list of raw messages of 'SMS' folder or dict folder -> list of raw messages,
+                UID is the position in list starting from 1
+        :param uidvalidity: UIDVALIDITY of the folders
+        :param capabilities: capabilities to advertise, add X-GM-EXT-1 to look like Gmail
+        """
+        self.folders = messages if isinstance(messages, dict) else {'SMS': messages}
+        self.uidvalidity = uidvalidity
+        self.capabilities = capabilities
+        self.generation = 0 # Incremented to drop idling connections
+        super().__init__(('127.0.0.1', 0), IMAPStubHandler)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def connect(self):
+        """
+        :return: logged in mailbox reader with selected folder
+        """
+        mb_reader = imaplib.IMAP4(*self.server_address)
+        mb_reader.login("bench", "bench")
+        mb_reader.select(next(iter(self.folders)))
+        return mb_reader
+
+    def deliver(self, raw, folder='SMS'):
+        """
+        Add message to the folder, idling sessions get EXISTS response
+        :param raw: raw message as bytes
+        :param folder: folder name
+        """
+        self.folders[folder].append(raw)
+
+    def drop(self):
+        """
+        Close idling connections as if network went down
+        """
+        self.generation += 1
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of this process in MB
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_stage(bank, stage, size, fmt='xlsx'):
+    """
+    Prepare input of the stage and measure it
+    :param bank: bank name
+    :param stage: one of STAGES
+    :param size: number of messages in corpus, not used by 'startup' stage (empty archive is read)
+    :param fmt: output format of 'save' stage
+    :return: dict with 'items', 'seconds' and 'peak_rss_mb' keys
+    """
+    if stage == 'startup': # Cold start of sbermaster.py in a new interpreter, it's import time mostly
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sbermaster.py")
+        with tempfile.NamedTemporaryFile(suffix=".mbox") as empty:
+            seconds = []
+            for run in range(STARTUP_RUNS):
+                start = time.perf_counter()
+                subprocess.run([sys.executable, script, "-b", bank, "--source", "mbox:" + empty.name],
+                               stdout=subprocess.DEVNULL, check=True)
+                seconds.append(time.perf_counter() - start)
+        rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return {'items': 1, 'seconds': min(seconds), 'peak_rss_mb': rss / (1024 * 1024 if sys.platform == 'darwin'
+                                                                           else 1024)}
+
+    module = banks.load(bank)
+    sms_list = make_corpus(bank, size)
+
+    if stage == 'imap':
+        server = IMAPStub([raw_message(sms, uid) for uid, sms in enumerate(sms_list, 1)])
+        mb_reader = server.connect()
+        start = time.perf_counter()
+        items = sum(1 for sms in sbermaster.process_mailbox(mb_reader, "(ALL)", module.stop_words,
+                                                            exclude=banks.server_exclude([module])))
+        seconds = time.perf_counter() - start
+        mb_reader.logout()
+        server.shutdown()
+        return {'items': size, 'passed': items, 'seconds': seconds, 'peak_rss_mb': peak_rss()}
+
+    if stage == 'stop_words':
+        start = time.perf_counter()
+        items = sum(1 for sms in sms_list if module.stop_words(sms))
+        return {'items': size, 'passed': items, 'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss()}
+
+    sms_list = [sms for sms in sms_list if module.stop_words(sms)]
+    if stage == 'parse':
+        start = time.perf_counter()
+        oper, trf = module.parse_sms_list(sms_list)
+        return {'items': len(sms_list), 'parsed': len(oper) + len(trf), 'seconds': time.perf_counter() - start,
+                'peak_rss_mb': peak_rss()}
+
+    oper, trf = module.process_sms_list(sms_list)
+    if stage == 'transfers':
+        if not hasattr(module, 'match_transfers'):
+            return None
+        start = time.perf_counter()
+        module.match_transfers(oper, trf)
+        return {'items': len(oper) + len(trf), 'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss()}
+
+    if stage == 'save':
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            sbermaster.save_operations((oper, trf), os.path.join(tmp, "bench." + fmt), fmt=fmt)
+            return {'items': len(oper) + len(trf), 'seconds': time.perf_counter() - start,
+                    'peak_rss_mb': peak_rss()}
+
+    raise ValueError("Unknown stage " + stage)
+
+
+def measure(bank, stage, size, fmt='xlsx'):
+    """
+    Run stage in a separate process, so peak RSS belongs to this stage only
+    :return: dict of results as returned by run_stage, None if stage doesn't apply to the bank
+    """
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-stage", bank, stage, str(size), fmt],
+                         stdout=subprocess.PIPE, check=True).stdout
+    result = json.loads(out.decode().strip().splitlines()[-1])
+    if result:
+        result['msgs_per_sec'] = result['items'] / result['seconds'] if result['seconds'] else 0
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Find regressions against saved baseline
+    :param results: dict key -> result
+    :param baseline: dict key -> result loaded from baseline file
+    :param tolerance: allowed relative slowdown and memory growth (0.2 = 20%)
+    :return: list of regression descriptions
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if not result or not base:
+            continue
+        if result['msgs_per_sec'] < base['msgs_per_sec'] * (1 - tolerance):
+            regressions.append("%s: %.0f msgs/s, baseline %.0f" % (key, result['msgs_per_sec'], base['msgs_per_sec']))
+        if result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + tolerance):
+            regressions.append("%s: %.1f MB peak RSS, baseline %.1f" % (key, result['peak_rss_mb'],
+                                                                        base['peak_rss_mb']))
+    return regressions
+
+
+def process_arguments():
+    parser = argparse.ArgumentParser(description="Measure throughput of sbermaster stages on synthetic SMS",
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-b", "--bank", help="Banks to measure", nargs="+", choices=sorted(banks.BANKS),
+                        default=sorted(banks.BANKS))
+    parser.add_argument("-n", "--sizes", help="Corpus sizes, 1000 to 1000000 messages", nargs="+", type=int, default=[1000, 10000])
+    parser.add_argument("--stages", help="Stages to measure ('startup' is measured once per bank, its Msgs/s "
+                                         "are starts per second)", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("-F", "--format", help="Output format of save stage", default="xlsx")
+    parser.add_argument("--baseline", help="Compare with results saved in this JSON file")
+    parser.add_argument("--save-baseline", help="Save results to this JSON file")
+    parser.add_argument("--tolerance", help="Allowed slowdown or memory growth against baseline", type=float,
+                        default=0.2)
+    parser.add_argument("--fuzz", help="Check token parsers against regexes of rules on this many fuzzed SMS "
+                                       "per bank instead of measuring stages", type=int)
+    parser.add_argument("--decode", help="Check decoding of SMS in other mailers' forms (base64, quoted-printable, "
+                                         "multipart) on this many SMS per bank instead of measuring stages",
+                        type=int)
+    parser.add_argument("--pathological", help="Time regexes and token parsers of rules on near miss SMS with "
+                                               "these repeat counts instead of measuring stages", nargs="+", type=int)
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) == 6 and sys.argv[1] == "--run-stage":
+        print(json.dumps(run_stage(sys.argv[2], sys.argv[3], int(sys.argv[4]), sys.argv[5])))
+        sys.exit(0)
+
+    config_opts = process_arguments()
+
+    if config_opts['fuzz']:
+        failed = False
+        for bank in config_opts['bank']:
+            matched, differ = check_parsers(bank, fuzz_corpus(bank, config_opts['fuzz']))
+            print("%-10s %9d messages %9d regex matches %6d differ" % (bank, config_opts['fuzz'], matched,
+                                                                        len(differ)))
+            for name, body, expected, values in differ[:10]:
+                print("DIFFER: %s %r\n  regex  %r\n  parser %r" % (name, body, expected, values))
+            failed = failed or bool(differ)
+        sys.exit(1 if failed else 0)
+
+    if config_opts['decode']:
+        failed = False
+        for bank in config_opts['bank']:
+            decoded, differ = check_decoding(make_corpus(bank, config_opts['decode']))
+            print("%-10s %9d messages decoded %6d differ" % (bank, decoded, len(differ)))
+            for name, sms, records in differ[:10]:
+                print("DIFFER: %s %r\n  decoded %r" % (name, sms, records))
+            failed = failed or bool(differ)
+        sys.exit(1 if failed else 0)
+
+    if config_opts['pathological']:
+        print("%-10s %-12s %8s %12s %12s" % ("Bank", "Rule", "Length", "Regex ms", "Parser ms"))
+        for bank in config_opts['bank']:
+            for name, length, regex, parse in pathological(bank, config_opts['pathological']):
+                print("%-10s %-12s %8d %12.3f %12.3f" % (bank, name, length, regex * 1000, parse * 1000))
+        sys.exit(0)
+
+    results = {}
+    print("%-10s %-11s %9s %12s %10s" % ("Bank", "Stage", "Messages", "Msgs/s", "Peak MB"))
+    for bank in config_opts['bank']:
+        runs = [(stage, 0) for stage in config_opts['stages'] if stage == 'startup'] # Doesn't depend on size
+        runs += [(stage, size) for size in config_opts['sizes'] for stage in config_opts['stages'] if stage != 'startup']
+        for stage, size in runs:
+            result = measure(bank, stage, size, config_opts['format'])
+            if not result:
+                continue
+            results["%s/%s/%d" % (bank, stage, size)] = result
+            print("%-10s %-11s %9d %12.0f %10.1f" % (bank, stage, size, result['msgs_per_sec'],
+                                                     result['peak_rss_mb']))
+
+    if config_opts['save_baseline']:
+        with open(config_opts['save_baseline'], 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if config_opts['baseline']:
+        with open(config_opts['baseline']) as f:
+            regressions = compare(results, json.load(f), config_opts['tolerance'])
+        for r in regressions:
+            print("REGRESSION:", r)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,107 @@
+#!/usr/local/bin/python3
+
+import re, time, functools
+from datetime import datetime
+
+# Formats used by SMS and SMS Backup+ headers, anything else goes to dateutil
+HEADER_RE = re.compile(r'(?:[A-Za-z]{3}, )?([0-9]{1,2}) ([A-Za-z]{3}) ([0-9]{4}) ([0-9]{2}):([0-9]{2})(?::([0-9]{2}))? '
+                       r'([+-])([0-9]{2})([0-9]{2})$')
+TIME_RE = re.compile(r'([0-9]{1,2}):([0-9]{2})$')
+DATE_RE = re.compile(r'([0-9]{1,2})\.([0-9]{1,2})\.([0-9]{4}|[0-9]{2})(?: ([0-9]{1,2}):([0-9]{2}))?$')
+
+MONTHS = {m: n + 1 for n, m in enumerate(('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                                          'jul', 'aug', 'sep', 'oct', 'nov', 'dec'))}
+
+
+def date_parse(value, **kwargs):
+    """
+    dateutil.parser.parse, dateutil is imported on first use as most dates never get here
+    """
+    from dateutil.parser import parse
+    return parse(value, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def tzoffset(offset):
+    """
+    :param offset: UTC offset in seconds
+    :return: dateutil timezone object, same as dateutil.parser.parse makes
+    """
+    from dateutil import tz
+    return tz.tzoffset(None, offset)
+
+
+def convert_year(year):
+    """
+    Two-digit year to four-digit one, the same way as dateutil does
+    :param year: two-digit year
+    :return: year within 50 years from now
+    """
+    this_year = time.localtime().tm_year
+    year += this_year // 100 * 100
+    if year >= this_year + 50:
+        year -= 100
+    elif year < this_year - 50:
+        year += 100
+    return year
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_header(value):
+    """
+    Parse Date header of a message
+    :param value: header value as string
+    :return: timezone aware datetime object, same as dateutil.parser.parse
+    """
+    values = HEADER_RE.match(value)
+    month = MONTHS.get(values.group(2).lower()) if values else None
+    offset = (int(values.group(8)) * 3600 + int(values.group(9)) * 60) * (-1 if values.group(7) == '-' else 1) \
+        if values else 0
+    if not month or not offset: # dateutil picks local or UTC timezone for zero offset
+        return date_parse(value)
+
+    return datetime(int(values.group(3)), month, int(values.group(1)), int(values.group(4)), int(values.group(5)),
+                    int(values.group(6) or 0), tzinfo=tzoffset(offset))
+
+
+@functools.lru_cache(maxsize=4096)
+def sms_fields(value):
+    """
+    Date and time fields of SMS time string
+    :param value: 'HH:MM', 'DD.MM.YY', 'DD.MM.YY HH:MM' or 'DD.MM.YYYY HH:MM'
+    :return: dict of datetime fields, None for unknown format
+    """
+    values = TIME_RE.match(value)
+    if values:
+        return {'hour': int(values.group(1)), 'minute': int(values.group(2))}
+
+    values = DATE_RE.match(value)
+    if not values or not 0 < int(values.group(1)) <= 31 or not 0 < int(values.group(2)) <= 12:
+        return None # dateutil reorders day, month and year then
+
+    year = values.group(3)
+    fields = {'year': int(year) if len(year) == 4 else convert_year(int(year)),
+              'month': int(values.group(2)), 'day': int(values.group(1))}
+    if values.group(4):
+        fields.update({'hour': int(values.group(4)), 'minute': int(values.group(5))})
+    return fields
+
+
+def parse_sms_time(value, default=None):
+    """
+    Parse time written in SMS, day goes first
+    :param value: time string
+    :param default: datetime object, fields missing in value are taken from it (today if none)
+    :return: datetime object, same as dateutil.parser.parse with dayfirst=True
+    """
+    fields = sms_fields(value)
+    if fields is None:
+        return date_parse(value, default=default, dayfirst=True)
+
+    if default is None:
+        default = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return default.replace(**fields)
+
+
+if __name__ == "__main__":
+    print("This module is for import only")
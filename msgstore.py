@@ -0,0 +1,77 @@
+#!/usr/local/bin/python3
+
+import sqlite3
+from datetime import datetime
+
+
+class MessageStore:
+    """
+    Local SQLite store of already fetched SMS messages.
+    Keeps UIDVALIDITY and the highest fetched UID for every folder/search pair,
+    so next runs ask the server only for messages above that UID
+    """
+
+    def __init__(self, path):
+        """
+        Open (create if needed) message store
+        :param path: SQLite database file name
+        """
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS folders "
+                        "(key TEXT PRIMARY KEY, uidvalidity INTEGER, last_uid INTEGER, since TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages "
+                        "(key TEXT, uid INTEGER, part INTEGER, time TEXT, body TEXT, PRIMARY KEY (key, uid, part))")
+        self.db.commit()
+
+    def begin(self, key, uidvalidity, since):
+        """
+        Start synchronization of a folder, drops stored messages if they are no longer valid
+        (UIDVALIDITY changed or earlier start date requested)
+        :param key: folder and search string identifying stored messages
+        :param uidvalidity: UIDVALIDITY of selected folder
+        :param since: start date as datetime.date
+        :return: last stored UID, 0 if nothing is stored
+        """
+        row = self.db.execute("SELECT uidvalidity, last_uid, since FROM folders WHERE key = ?", (key,)).fetchone()
+        if row and row[0] == uidvalidity and row[2] <= since.isoformat():
+            return row[1]
+
+        self.db.execute("DELETE FROM messages WHERE key = ?", (key,))
+        self.db.execute("INSERT OR REPLACE INTO folders (key, uidvalidity, last_uid, since) VALUES (?, ?, 0, ?)",
+                        (key, uidvalidity, since.isoformat()))
+        self.db.commit()
+        return 0
+
+    def add(self, key, uid, records):
+        """
+        Store decoded message and move high-water mark
+        :param key: folder and search string identifying stored messages
+        :param uid: message UID
+        :param records: list of dicts {'time', 'body'} decoded from the message
+        :return: None
+        """
+        self.db.executemany("INSERT OR REPLACE INTO messages (key, uid, part, time, body) VALUES (?, ?, ?, ?, ?)",
+                            [(key, uid, part, r['time'].isoformat(), r['body']) for part, r in enumerate(records)])
+        self.db.execute("UPDATE folders SET last_uid = ? WHERE key = ? AND last_uid < ?", (uid, key, uid))
+
+    def commit(self):
+        self.db.commit()
+
+    def records(self, key, since):
+        """
+        Read stored messages
+        :param key: folder and search string identifying stored messages
+        :param since: start date as datetime.date
+        :return: generator of dicts {'time', 'body'} in UID order
+        """
+        cursor = self.db.execute("SELECT time, body FROM messages WHERE key = ? AND substr(time, 1, 10) >= ? "
+                                 "ORDER BY uid, part", (key, since.isoformat()))
+        for time, body in cursor:
+            yield {'time': datetime.fromisoformat(time), 'body': body}
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == "__main__":
+    print("This module is for import only")
@@ -0,0 +1,70 @@
+#!/usr/local/bin/python3
+
+
+class Record:
+    """
+    Base of compact records with fixed fields. Fields are attributes, but records can be
+    read as dicts (record['sum'], record.get('transfer'), record.keys()) as it was before
+    """
+    __slots__ = ()
+    OPTIONAL = () # Fields missing from dict view while they are None
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError("Unknown fields: " + ", ".join(fields))
+
+    def keys(self):
+        return [name for name in self.__slots__ if name not in self.OPTIONAL or getattr(self, name) is not None]
+
+    def __getitem__(self, key):
+        if key not in self.keys():
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.keys() else default
+
+    def as_dict(self):
+        """
+        :return: dict with the same keys as operations and transfers had before records
+        """
+        return {name: (value.as_dict() if isinstance(value, Record) else value)
+                for name, value in ((name, getattr(self, name)) for name in self.keys())}
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, n) == getattr(other, n) for n in self.__slots__)
+
+    __hash__ = None # Records are mutable and compared by fields, sets and dicts keep their id()
+
+    def __repr__(self):
+        return type(self).__name__ + "(" + ", ".join(n + "=" + repr(getattr(self, n)) for n in self.keys()) + ")"
+
+
+class Transfer(Record):
+    """
+    Money transfer: sender or receiver name, sum and comment. Transfers written in
+    the operation SMS itself have no sum and currency. Bank is set when SMS of several banks are parsed
+    """
+    __slots__ = ('time', 'name', 'sum', 'currency', 'comment', 'bank')
+    OPTIONAL = ('sum', 'currency', 'bank')
+
+
+class Operation(Record):
+    """
+    Card operation, transfer is None if no transfer is attached. Bank is set when SMS of several banks are parsed
+    """
+    __slots__ = ('time', 'card', 'time1', 'oper', 'sum', 'currency', 'comission', 'commcurr', 'place', 'bal',
+                 'transfer', 'bank')
+    OPTIONAL = ('transfer', 'bank')
+
+
+if __name__ == "__main__":
+    print("This module is for import only")
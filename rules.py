@@ -0,0 +1,327 @@
+#!/usr/local/bin/python3
+
+import re, pprint
+
+TABLES = {} # All rule tables by bank name
+
+
+NUMBER = re.compile(r'[0-9]+(?:\.[0-9]+)*') # Sum token of Sberbank SMS
+DIGITS = re.compile(r'[0-9.]+') # Sum token of VTB and VestaBank SMS
+NEWLINES = re.compile(r'[\r\n]+')
+ANCHORS = 8 # Occurrences of a keyword token parsers try, real SMS have one of each
+
+
+class Groups(tuple):
+    """
+    Match object made by token parser: groups are numbered from 1 as regex groups are, missing groups are None
+    """
+    __slots__ = ()
+
+    def group(self, n):
+        return self[n - 1]
+
+    def groups(self):
+        return tuple(self)
+
+
+def line_end(text, pos=0):
+    """
+    :param text: SMS text
+    :param pos: position in the line
+    :return: position of line feed ending the line, length of text for the last line
+    """
+    end = text.find('\n', pos)
+    return len(text) if end < 0 else end
+
+
+def keywords(text, words, pos, end, reverse=False):
+    """
+    Positions of keyword in order the regex tries them, at most ANCHORS of them so the parser stays linear
+    :param text: SMS text
+    :param words: string or tuple of strings
+    :param pos: position to search from
+    :param end: position the keyword must end before
+    :param reverse: the last keyword goes first
+    :return: generator of positions
+    """
+    find = text.rfind if reverse else text.find
+    for n in range(ANCHORS):
+        if isinstance(words, str):
+            at = find(words, pos, end)
+        else:
+            found = [a for a in (find(w, pos, end) for w in words) if a >= 0]
+            at = (max(found) if reverse else min(found)) if found else -1
+        if at < 0:
+            return
+        yield at
+        if reverse:
+            end = at
+        else:
+            pos = at + 1
+
+
+def number(text, pos, end, token=NUMBER):
+    """
+    Sum token followed by at least one character before end, the way greedy regex group gives back
+    its last digit to the lazy group after it
+    :param text: SMS text
+    :param pos: token start
+    :param end: position the token must end before
+    :param token: compiled regex of the token
+    :return: token end, -1 if there is no token
+    """
+    found = token.match(text, pos, end)
+    if found and found.end() == end:
+        found = token.match(text, pos, end - 1)
+    return found.end() if found else -1
+
+
+def first_number(text, pos, end, token=NUMBER):
+    """
+    First sum token which is preceded by space and followed by space
+    :param text: SMS text
+    :param pos: position to search space from
+    :param end: position the space after token must be before
+    :param token: compiled regex of the token
+    :return: tuple (position of space before token, token end), (-1, -1) if there is no token
+    """
+    space = text.find(' ', pos, end)
+    while space >= 0:
+        found = token.match(text, space + 1, end)
+        if found and text.startswith(' ', found.end()):
+            return space, found.end()
+        space = text.find(' ', space + 1, end)
+    return -1, -1
+
+
+def last_number(text, pos, end, token=NUMBER):
+    """
+    Last sum token preceded by space, the way greedy regex group before the sum splits the text
+    :param text: SMS text
+    :param pos: position to search space from
+    :param end: position the token must end before, see number
+    :param token: compiled regex of the token
+    :return: tuple (position of space before token, token end), (-1, -1) if there is no token
+    """
+    space = text.rfind(' ', pos, end)
+    while space >= 0:
+        total = number(text, space + 1, end, token)
+        if total >= 0:
+            return space, total
+        space = text.rfind(' ', pos, space)
+    return -1, -1
+
+
+def card_token(text, token, end, colon=False):
+    """
+    Card name and the token after it, the way lazy regex group (.+?) before ' <token>' splits the text
+    :param text: SMS text
+    :param token: compiled regex of the token
+    :param end: position the token must end before
+    :param colon: colon may end the card name
+    :return: tuple (card end, token match), None if there is no token
+    """
+    space = text.find(' ', 1, end)
+    while space >= 0:
+        found = token.match(text, space + 1, end)
+        if found:
+            return (space - 1 if colon and space > 1 and text[space - 1] == ':' else space), found
+        space = text.find(' ', space + 1, end)
+    return None
+
+
+class Rule:
+    """
+    SMS format: regular expression, cheap literal checks that must pass before the regex is tried,
+    and handler that makes operation or transfer from match object. Rule with parse function matches
+    messages with it, regex stays the reference of the format which the parser must agree with.
+    Parse function takes linear time: the usual form of message goes through a one-pass regex (every group
+    stops at the first character of the text after it, every keyword occurrence is checked once, so nothing
+    backtracks), token parser takes the message when it isn't in usual form. 'bench.py --fuzz N' checks
+    both against the rule regex
+    """
+    __slots__ = ('name', 'regex', 'parse', 'handler', 'kind', 'prefix', 'markers', 'hits', 'misses')
+
+    def __init__(self, name, regex, handler, kind='oper', prefix=None, markers=(), parse=None):
+        """
+        :param name: rule name
+        :param regex: regular expression string, applied with match()
+        :param handler: function(values, transaction) that returns dict of operation or transfer
+        :param kind: 'oper' for card operations, 'trf' for money transfers
+        :param prefix: string or tuple of strings, message must start with one of them
+        :param markers: tuple of strings or tuples of strings, message must contain every string
+                (one of tuple strings)
+        :param parse: function(body) that returns the same groups as regex in linear time (Groups or match
+                object), None if message doesn't match; regex with nested lazy and greedy groups backtracks
+                polynomially on long messages which nearly match
+        """
+        self.name = name
+        self.regex = re.compile(regex)
+        self.parse = parse or self.regex.match
+        self.handler = handler
+        self.kind = kind
+        self.prefix = prefix
+        self.markers = tuple((m,) if isinstance(m, str) else m for m in markers)
+        self.hits = 0 # Messages parsed by the rule
+        self.misses = 0 # Messages passed literal checks but not matched by regex
+
+
+class RuleTable:
+    """
+    Ordered list of bank SMS formats. The first rule matching the message wins as it was in
+    if/elif chain, but regex of a rule is tried only if the message passes its literal checks
+    """
+
+    def __init__(self, bank):
+        """
+        :param bank: bank name, table is registered in TABLES under this name
+        """
+        self.bank = bank
+        self.rules = []
+        self.unknown = 0
+        TABLES[bank] = self
+
+    def rule(self, regex, kind='oper', prefix=None, markers=(), parse=None):
+        """
+        Decorator registering handler function as a rule, see Rule for parameters
+        """
+        def register(handler):
+            self.rules.append(Rule(handler.__name__, regex, handler, kind, prefix, markers, parse))
+            return handler
+        return register
+
+    def candidates(self, body):
+        """
+        Rules that can match the message
+        :param body: SMS text
+        :return: generator of rules in registration order
+        """
+        present = {}
+        for rule in self.rules:
+            if rule.prefix and not body.startswith(rule.prefix):
+                continue
+            for alternatives in rule.markers:
+                if alternatives not in present:
+                    present[alternatives] = any(m in body for m in alternatives)
+                if not present[alternatives]:
+                    break
+            else:
+                yield rule
+
+    def match(self, body):
+        """
+        Find rule for the message
+        :param body: SMS text
+        :return: tuple (rule, match object), (None, None) if no rule matches
+        """
+        for rule in self.candidates(body):
+            values = rule.parse(body)
+            if values:
+                rule.hits += 1
+                return rule, values
+            rule.misses += 1
+        self.unknown += 1
+        return None, None
+
+    def process(self, transaction):
+        """
+        Parse the message
+        :param transaction: dict with 'time' and 'body' keys
+        :return: tuple (kind, dict of operation or transfer), (None, None) if message is unknown
+        """
+        rule, values = self.match(transaction['body'])
+        if rule is None:
+            return None, None
+        return rule.kind, rule.handler(values, transaction)
+
+    def parse_sms_list(self, trans_list, warn=False):
+        """
+        Parse every SMS on its own, transfers are not attached to operations
+        :param trans_list: list of transactions as dicts with 'time' and 'body' keys
+        :param warn: print warnings
+        :return: tuple of (operations, transfers), lists of records.Operation and records.Transfer
+        """
+        oper = []  # Card operations
+        trf = []  # Money transfers
+
+        for transaction in trans_list:
+            try:
+                kind, values = self.process(transaction)
+                if kind == 'oper':
+                    oper.append(values)
+                    continue
+                if kind == 'trf':
+                    trf.append(values)
+                    continue
+                if warn:
+                    print("WARNING: unknown transaction")
+                    pprint.pprint(transaction)
+            except:
+                print("ERROR: unable to process")
+                pprint.pprint(transaction)
+
+        return oper, trf
+
+    def take_counters(self):
+        """
+        Read and reset counters, used to pass counters from worker processes
+        :return: tuple (list of (hits, misses) in rule order, unknown)
+        """
+        counters = [(r.hits, r.misses) for r in self.rules], self.unknown
+        for r in self.rules:
+            r.hits = r.misses = 0
+        self.unknown = 0
+        return counters
+
+    def add_counters(self, counters):
+        """
+        Add counters taken with take_counters
+        :param counters: tuple (list of (hits, misses) in rule order, unknown)
+        """
+        for r, (hits, misses) in zip(self.rules, counters[0]):
+            r.hits += hits
+            r.misses += misses
+        self.unknown += counters[1]
+
+    def stats(self):
+        """
+        Rule counters
+        :return: list of dicts with 'bank', 'rule', 'hits', 'misses' keys
+        """
+        return [{'bank': self.bank, 'rule': r.name, 'hits': r.hits, 'misses': r.misses} for r in self.rules]
+
+
+class StopWords:
+    """
+    Message filter made of lowercase phrases, every list is compiled into single regex
+    so the message text is scanned once
+    """
+
+    def __init__(self, exclude=(), include=()):
+        """
+        :param exclude: message is dropped if it contains any of these phrases
+        :param include: message is dropped if it contains none of these phrases (no check if empty)
+        """
+        self.exclude = re.compile('|'.join(map(re.escape, exclude))) if exclude else None
+        self.include = re.compile('|'.join(map(re.escape, include))) if include else None
+
+    def check(self, text):
+        """
+        :param text: SMS text
+        :return: False if message must be dropped
+        """
+        text = text.lower()
+        if self.include and not self.include.search(text):
+            return False
+        return not (self.exclude and self.exclude.search(text))
+
+    def __call__(self, message):
+        """
+        :param message: dict with 'body' key
+        :return: False if message must be dropped
+        """
+        return self.check(message['body'])
+
+
+if __name__ == "__main__":
+    print("This module is for import only")
@@ -1,172 +1,422 @@
 #!/usr/local/bin/python3
 
-import re, pprint
+import bisect, re
 from decimal import Decimal
-from dateutil.parser import parse as date_parse
+from dates import parse_sms_time
+from rules import RuleTable, StopWords, Groups, NUMBER, NEWLINES, line_end, keywords, number, last_number, \
+    card_token
+from records import Operation, Transfer
 
 
-def stop_words(message):
-    for word in ('пароль', 'вход в сбербанк', 'никому не сообщайте код', 'недостаточно средств'):
-        if word in message['body'].lower():
-            return False
-    return True
+SEARCH = "FROM 900" # Default IMAP search string
+SENDERS = ("900",) # Strings of From header of bank SMS
 
+stop_words = StopWords(exclude=('пароль', 'вход в сбербанк', 'никому не сообщайте код', 'недостаточно средств'))
+SERVER_EXCLUDE = ('пароль', 'никому не сообщайте код', 'вход в сбербанк', 'недостаточно средств')
 
-def process_sms_list(trans_list, warn=False):
+
+MAXDELTA = 150 # maximum seconds between transaction and operation SMS-es
+
+rules = RuleTable('sberbank')
+
+# Time is 'HH:MM' or 'DD.MM.YY HH:MM', currency is written right after the sum
+TIME = re.compile(r'(?:[0-9]+\.[0-9]+\.[0-9]+ )?[0-9]+:[0-9]+ ')
+DATE = re.compile(r'[0-9]+\.[0-9]+\.[0-9]+ ')
+STAMP = re.compile(r'[0-9.:]+ ')
+UNQUOTED = re.compile(r'[^"]+')
+CURRENCY = re.compile(r'[^ .]+')
+BALANCE = ' Баланс: '
+COMISSION = ' с комиссией '
+# Usual forms of purchase and mobile bank fee: ' Баланс: ' is written once in the first line
+PURCHASE = re.compile(r'([^ \n]+) ((?:[0-9]+\.[0-9]+\.[0-9]+ )?[0-9]+:[0-9]+) ([^ \n]+(?: [^ 0-9\n][^ \n]*)*) '
+                      r'([0-9]+(?:\.[0-9]+)*)([^0-9. \n][^ \n]*)'
+                      r'(?: с комиссией ([0-9]+(?:\.[0-9]+)*)([^0-9. \n][^ \n]*)|(?! с комиссией ))'
+                      r'( (?:(?! Баланс: )[^\n])+)? Баланс: ([0-9]+(?:\.[0-9]+)*)(?:(?! Баланс: )[^\n])+(?![^\n])')
+MOBILEBANK = re.compile(r'([^ \n]+) ([0-9]+\.[0-9]+\.[0-9]+) ([^\n]+) ([0-9]+(?:\.[0-9]+)*)([^0-9. \n][^ \n]*) '
+                        r'Баланс: ([0-9]+(?:\.[0-9]+)*)(?:(?! Баланс: )[^\n])+(?![^\n])')
+
+
+def last_balance(body, end):
     """
-    Make list of operations from list of SMS
+    The last ' Баланс: <sum>' of the first line, greedy regex groups before it take the text up to it
+    :param body: SMS text
+    :param end: end of the first line
+    :return: tuple (position of ' Баланс: ', balance end), (-1, -1) if there is none
+    """
+    for at in keywords(body, BALANCE, 1, end, reverse=True):
+        bal = number(body, at + len(BALANCE), end)
+        if bal >= 0:
+            return at, bal
+    return -1, -1
+
+
+def balance_line(body, end, title):
+    """
+    Start of balance line which follows the first line
+    :param body: SMS text
+    :param end: end of the first line
+    :param title: text the balance line starts with
+    :return: position after title, -1 if there is no such line
+    """
+    newlines = NEWLINES.match(body, end)
+    if not newlines or not body.startswith(title, newlines.end()):
+        return -1
+    return newlines.end() + len(title)
+
+
+def quoted_message(body, pos):
+    """
+    Message of transfer on the lines after balance, (?:[\r\n]+Сообщение: "(.+?)")? of regex
+    :param body: SMS text
+    :param pos: position after balance currency
+    :return: message text, None if there is no message
+    """
+    newlines = NEWLINES.match(body, pos)
+    if not newlines or not body.startswith('Сообщение: "', newlines.end()):
+        return None
+    start = newlines.end() + len('Сообщение: "')
+    quote = body.find('"', start + 1, line_end(body, start))
+    return body[start:quote] if quote >= 0 else None
+
+
+def transfer_line(body, end, sender, colon=False):
+    """
+    Line of transfer '<card>[:] <time> <operation> <sum><currency>[.]<sender><name>',
+    (.+?):? ([0-9.:]+) (.+) (N)(.+?)\.?<sender>(.+) of regex
+    :param body: SMS text
+    :param end: line end
+    :param sender: words before sender name
+    :param colon: colon may end the card name
+    :return: list of card, time, operation, sum, currency and name, None if the line doesn't match
+    """
+    last = body.rfind(sender, 0, end - 1) if end > 0 else -1 # Name has at least one character
+    head = card_token(body, STAMP, last, colon) if last > 0 else None
+    if not head:
+        return None
+    card, stamp = head
+    space, total = last_number(body, stamp.end() + 1, last)
+    if space < 0:
+        return None
+    name = body.find(sender, total + 1)
+    currency = name - 1 if name - 1 > total and body[name - 1] == '.' else name
+    return [body[:card], stamp.group()[:-1], body[stamp.end():space], body[space + 1:total], body[total:currency],
+            body[name + len(sender):end]]
+
+
+def parse_receivenew2(body):
+    """
+    Token parser of receivenew2
+    :param body: SMS text
+    :return: Groups object, None if message doesn't match
+    """
+    end = body.find('\n')
+    start = balance_line(body, end, 'Баланс ') if end > 0 and body.startswith('Перевод ') else -1
+    last = body.rfind(' от ', 0, end - 1) if start >= 0 else -1
+    total = number(body, 8, last) if last > 0 else -1
+    if total < 0:
+        return None
+    name = body.find(' от ', total + 1)
+    bal_end = line_end(body, start)
+    colon = body.find(': ', start + 1, bal_end)
+    while colon >= 0:
+        bal = number(body, colon + 2, bal_end)
+        if bal >= 0:
+            return Groups((body[8:total], body[total:name], body[name + 4:end], body[start:colon],
+                           body[colon + 2:bal], body[bal], quoted_message(body, bal + 1)))
+        colon = body.find(': ', colon + 1, bal_end)
+    return None
+
+
+def parse_receivenew(body):
+    """
+    Token parser of receivenew
+    :param body: SMS text
+    :return: Groups object, None if message doesn't match
+    """
+    end = body.find('\n')
+    start = balance_line(body, end, 'Баланс: ') if end > 0 else -1
+    bal = number(body, start, line_end(body, start)) if start >= 0 else -1
+    line = transfer_line(body, end, ' от ') if bal >= 0 else None
+    if not line:
+        return None
+    return Groups((*line, body[start:bal], body[bal], quoted_message(body, bal + 1)))
+
+
+def parse_purchase(body):
+    """
+    Token parser of purchase
+    :param body: SMS text
+    :return: Groups object, None if message doesn't match
+    """
+    values = PURCHASE.match(body)
+    if values:
+        return values
+    balance, bal = last_balance(body, line_end(body))
+    head = card_token(body, TIME, balance) if bal >= 0 else None
+    if not head:
+        return None
+    card, stamp = head
+    space = body.find(' ', stamp.end() + 1, balance)
+    while space >= 0 and not NUMBER.match(body, space + 1, balance):
+        space = body.find(' ', space + 1, balance)
+    total = number(body, space + 1, balance) if space >= 0 else -1
+    if total < 0:
+        return None
+    values = [body[:card], stamp.group()[:-1], body[stamp.end():space], body[space + 1:total]]
+    currency = body.find(' ', total + 1, balance + 1) # Place is at least a space and a character
+    if currency == balance - 1:
+        currency = balance
+    comission = number(body, currency + len(COMISSION), balance) if body.startswith(COMISSION, currency) else -1
+    if comission >= 0:
+        place = body.find(' ', comission + 1, balance + 1)
+        if place == balance - 1:
+            place = balance
+        values += [body[total:currency], body[currency + len(COMISSION):comission], body[comission:place]]
+    else:
+        place = currency
+        values += [body[total:currency], None, None]
+    return Groups((*values, body[place:balance] or None, body[balance + len(BALANCE):bal]))
+
+
+def parse_mobilebank(body):
+    """
+    Token parser of mobilebank
+    :param body: SMS text
+    :return: Groups object, None if message doesn't match
+    """
+    values = MOBILEBANK.match(body)
+    if values:
+        return values
+    balance, bal = last_balance(body, line_end(body))
+    head = card_token(body, DATE, balance) if bal >= 0 else None
+    if not head:
+        return None
+    card, stamp = head
+    space, total = last_number(body, stamp.end() + 1, balance)
+    if space < 0:
+        return None
+    return Groups((body[:card], stamp.group()[:-1], body[stamp.end():space], body[space + 1:total],
+                   body[total:balance], body[balance + len(BALANCE):bal]))
+
+
+def parse_transfer(body):
+    """
+    Token parser of transfer
+    :param body: SMS text
+    :return: Groups object, None if message doesn't match
+    """
+    end = line_end(body)
+    verb = body.find(' перевел', 18, end) if end > 16 and body[16] == ' ' and body.startswith('Сбербанк Онлайн') else -1
+    space = body.find(' ', verb + 9, end) if verb > 0 else -1
+    while space >= 0:
+        total = NUMBER.match(body, space + 1, end)
+        currency = CURRENCY.match(body, total.end() + 1) if total and body.startswith(' ', total.end()) else None
+        if currency:
+            pos = currency.end() + 1 if body.startswith('.', currency.end()) else currency.end()
+            message = None
+            if body.startswith(' Сообщение: ', pos):
+                pos += len(' Сообщение: ')
+                message = UNQUOTED.match(body, pos + 1 if body.startswith('"', pos) else pos)
+            return Groups((body[17:verb], total.group(), currency.group(), message.group() if message else None))
+        space = body.find(' ', space + 1, end)
+    return None
+
+
+def parse_receive(body):
+    """
+    Token parser of receive, message is never found by its regex: greedy name takes the rest of the line
+    :param body: SMS text
+    :return: Groups object, None if message doesn't match
+    """
+    line = transfer_line(body, line_end(body), ' от отправителя ', colon=True)
+    return Groups((*line, None)) if line else None
+
+
+@rules.rule(r'Перевод ([0-9]+(?:\.[0-9]+)*)(.+?) от (.+)[\r\n]+Баланс (.+?): ([0-9]+(?:\.[0-9]+)*)(.+?)(?:[\r\n]+Сообщение: "(.+?)")?',
+            prefix='Перевод ', markers=(' от ', 'Баланс '), parse=parse_receivenew2)
+def receivenew2(values, transaction): # Money transfers - new style (Jun 2019)
+    return Operation(
+        time=transaction['time'],
+        card=values.group(4),
+        time1=transaction['time'],
+        oper='Вх. перевод',
+        sum=Decimal(values.group(1)),
+        currency=values.group(2),
+        comission=None,
+        commcurr=None,
+        place=None,
+        bal=Decimal(values.group(5)),
+        transfer=Transfer(
+            name=values.group(3),
+            comment=values.group(7),
+            time=transaction['time']
+        )
+    )
+
+
+@rules.rule(r'(.+?) ([0-9.:]+) (.+) ([0-9]+(?:\.[0-9]+)*)(.+?)\.? от (.+)[\r\n]+Баланс: ([0-9]+(?:\.[0-9]+)*)(.+?)(?:[\r\n]+Сообщение: "(.+?)")?',
+            markers=(' от ', 'Баланс: '), parse=parse_receivenew)
+def receivenew(values, transaction): # Money transfers - new style (Apr 2019)
+    return Operation(
+        time=transaction['time'],
+        card=values.group(1),
+        time1=parse_sms_time(values.group(2), default=transaction['time']),
+        oper=values.group(3),
+        sum=Decimal(values.group(4)),
+        currency=values.group(5),
+        comission=None,
+        commcurr=None,
+        place=None,
+        bal=Decimal(values.group(7)),
+        transfer=Transfer(
+            name=values.group(6),
+            comment=values.group(9),
+            time=transaction['time']
+        )
+    )
+
+
+@rules.rule(r'(.+?) ((?:[0-9]+\.[0-9]+\.[0-9]+ )?[0-9]+:[0-9]+) (.+?) ([0-9]+(?:\.[0-9]+)*)(.+?)(?: с комиссией ([0-9]+(?:\.[0-9]+)*)(.+?))?( .+)? Баланс: ([0-9]+(?:\.[0-9]+)*)(?:.+)',
+            markers=(' Баланс: ',), parse=parse_purchase)
+def purchase(values, transaction): # Purchases, ATM operations and another incomes&expences
+    return Operation(
+        time=transaction['time'],
+        card=values.group(1),
+        time1=parse_sms_time(values.group(2), default=transaction['time']),
+        oper=values.group(3),
+        sum=Decimal(values.group(4)),
+        currency=values.group(5),
+        comission=Decimal(values.group(6)) if values.group(6) else None,
+        commcurr=values.group(7),
+        place=values.group(8),
+        bal=Decimal(values.group(9))
+    )
+
+
+@rules.rule(r'(.+?) ([0-9]+\.[0-9]+\.[0-9]+) (.+) ([0-9]+(?:\.[0-9]+)*)(.+?) Баланс: ([0-9]+(?:\.[0-9]+)*)(?:.+)',
+            markers=(' Баланс: ',), parse=parse_mobilebank)
+def mobilebank(values, transaction): # Mobile bank fees
+    return Operation(
+        time=transaction['time'],
+        card=values.group(1),
+        time1=parse_sms_time(values.group(2), default=transaction['time']),
+        oper=values.group(3),
+        sum=Decimal(values.group(4)),
+        currency=values.group(5),
+        comission=None,
+        commcurr=None,
+        place=None,
+        bal=Decimal(values.group(6))
+    )
+
+
+@rules.rule(r'Сбербанк Онлайн. (.+?) перевел(?:.+?) ([0-9]+(?:\.[0-9]+)*) ([^ .]+)\.?(?: Сообщение: "?([^"]+)"?)?',
+            kind='trf', prefix='Сбербанк Онлайн', markers=(' перевел',), parse=parse_transfer)
+def transfer(values, transaction): # Money transfers - old style, sender
+    return Transfer(
+        time=transaction['time'],
+        name=values.group(1),
+        sum=Decimal(values.group(2)),
+        currency=values.group(3),
+        comment=values.group(4)
+    )
+
+
+@rules.rule(r'(.+?):? ([0-9.:]+) (.+) ([0-9]+(?:\.[0-9]+)*)(.+?)\.? от отправителя (.+)(?: Сообщение: "?([^"]+)"?)?',
+            kind='trf', markers=(' от отправителя ',), parse=parse_receive)
+def receive(values, transaction): # Money transfers - old style, receiver
+    return Transfer(
+        time=transaction['time'],
+        name=values.group(6),
+        sum=Decimal(values.group(4)),
+        currency=values.group(5),
+        comment=values.group(7)
+    )
+
+
+def index_transfers(trf):
+    """
+    Group transfers by sum, sorted by time
+    :param trf: list of transfers
+    :return: dict sum -> tuple (list of times, list of transfers)
+    """
+    groups = {}
+    for t in trf:
+        groups.setdefault(t.sum, []).append(t)
+
+    index = {}
+    for total, transfers in groups.items():
+        transfers.sort(key=lambda t: t.time)
+        index[total] = ([t.time for t in transfers], transfers)
+    return index
+
+
+def find_transfer(o, index, used=None):
+    """
+    Finds transfer that best matches operation o (old style - person in separate SMS).
+    "Best" means sum equality and minimal time shift not more than MAXDELTA, earlier transfer wins a tie
+    :param o: operation
+    :param index: transfers index made by index_transfers
+    :param used: set of ids of transfers that are already attached to operations, they are skipped
+    :return: transfer the most relevant to operation, None if not found
+    """
+    if o.sum not in index:
+        return None
+    times, transfers = index[o.sum]
+
+    # Nearest unused transfers before and after operation time, the closer one wins
+    retval, min_seconds = None, MAXDELTA + 1
+    right = bisect.bisect_left(times, o.time)
+    for indexes in (range(right - 1, -1, -1), range(right, len(times))):
+        for i in indexes:
+            delta = abs(int((times[i] - o.time).total_seconds()))
+            if delta >= min_seconds:
+                break
+            if used is None or id(transfers[i]) not in used:
+                retval, min_seconds = transfers[i], delta
+                break
+
+    return retval
+
+
+def match_transfers(oper, trf, unique=False):
+    """
+    Attach transfers to incoming operations ('зачисление')
+    :param oper: list of operations
+    :param trf: list of transfers
+    :param unique: attach every transfer to one operation at most
+    :return: None
+    """
+    index = index_transfers(trf)
+    used = set() if unique else None
+    for o in oper:
+        if o.oper == 'зачисление':
+            o.transfer = find_transfer(o, index, used)
+            if unique and o.transfer is not None:
+                used.add(id(o.transfer))
+
+
+def parse_sms_list(trans_list, warn=False):
+    """
+    Parse every SMS on its own, transfers are not attached to operations
     :param warn: print warnings
     :param trans_list: list of transactions as dicts with 'time' and 'body' keys
-    :return: tuple of (operations, transfers), operations as list of dicts with 'card', 'time', time1', 'time2', 'operation', 'currency',
-            'sum', 'balance', 'person', 'place', 'name', 'sum1', 'comment' keys
-            transfers as list of dicts with 'name', 'sum', 'comment', 'time' keys
-    """
-    def find_transfer(o, trf):
-        """
-        Finds transfer in trf that best matches operation o (old style - person in separate SMS).
-        "Best" means minimal time shift and sum equality
-        :param o: operation
-        :param trf: list of transfers
-        :return: transfer the most relevant to operation
-        """
-        MAXDELTA = 150 # maximum seconds between transaction and operation SMS-es
-        candidates = []
-        min_seconds = 'Unknown'
-        retval = 'Not found'
-
-        for t in trf:
-            if t['sum'] == o['sum']:
-                candidates.append(t)
-        if not len(candidates):
-            return retval
-
-        for c in candidates:
-            delta = abs(int((c['time'] - o['time']).total_seconds()))
-            if delta > MAXDELTA:
-                continue
-            if min_seconds == 'Unknown':
-                min_seconds = delta
-                retval = c
-            elif min_seconds > delta:
-                min_seconds = delta
-                retval = c
-            else:
-                retval = c
-
-        return retval
-
-    oper = []  # Card operations
-    trf = []  # Money transfers
-
-    purchase_re = re.compile(r'(.+?) ((?:[0-9]+\.[0-9]+\.[0-9]+ )?[0-9]+:[0-9]+) (.+?) ([0-9]+(?:\.[0-9]+)*)(.+?)(?: с комиссией ([0-9]+(?:\.[0-9]+)*)(.+?))?( .+)? Баланс: ([0-9]+(?:\.[0-9]+)*)(?:.+)')
-    mobilebank_re = re.compile(r'(.+?) ([0-9]+\.[0-9]+\.[0-9]+) (.+) ([0-9]+(?:\.[0-9]+)*)(.+?) Баланс: ([0-9]+(?:\.[0-9]+)*)(?:.+)')
-    transfer_re = re.compile(r'Сбербанк Онлайн. (.+?) перевел(?:.+?) ([0-9]+(?:\.[0-9]+)*) ([^ .]+)\.?(?: Сообщение: "?([^"]+)"?)?')
-    receive_re = re.compile(r'(.+?):? ([0-9.:]+) (.+) ([0-9]+(?:\.[0-9]+)*)(.+?)\.? от отправителя (.+)(?: Сообщение: "?([^"]+)"?)?')
-    receivenew_re = re.compile(r'(.+?) ([0-9.:]+) (.+) ([0-9]+(?:\.[0-9]+)*)(.+?)\.? от (.+)[\r\n]+Баланс: ([0-9]+(?:\.[0-9]+)*)(.+?)(?:[\r\n]+Сообщение: "(.+?)")?')
-    receivenew2_re = re.compile(r'Перевод ([0-9]+(?:\.[0-9]+)*)(.+?) от (.+)[\r\n]+Баланс (.+?): ([0-9]+(?:\.[0-9]+)*)(.+?)(?:[\r\n]+Сообщение: "(.+?)")?')
-
-    for transaction in trans_list:
-        try:
-            values = receivenew2_re.match(transaction['body'])
-            if values: # Money transfers - new style (Jun 2019)
-                oper.append({
-                    'time': transaction['time'],
-                    'card': values.group(4),
-                    'time1': transaction['time'],
-                    'oper': 'Вх. перевод',
-                    'sum': Decimal(values.group(1)),
-                    'currency': values.group(2),
-                    'comission': None,
-                    'commcurr': None,
-                    'place': None,
-                    'bal': Decimal(values.group(5)),
-                    'transfer': {
-                        'name': values.group(3),
-                        'comment': values.group(7),
-                        'time': transaction['time']
-                    }
-                })
-                continue
-            values = receivenew_re.match(transaction['body'])
-            if values: # Money transfers - new style (Apr 2019)
-                oper.append({
-                    'time': transaction['time'],
-                    'card': values.group(1),
-                    'time1': date_parse(values.group(2), default=transaction['time'], dayfirst=True),
-                    'oper': values.group(3),
-                    'sum': Decimal(values.group(4)),
-                    'currency': values.group(5),
-                    'comission': None,
-                    'commcurr': None,
-                    'place': None,
-                    'bal': Decimal(values.group(7)),
-                    'transfer': {
-                        'name': values.group(6),
-                        'comment': values.group(9),
-                        'time': transaction['time']
-                    }
-                })
-                continue
-            values = purchase_re.match(transaction['body'])
-            if values: # Purchases, ATM operations and another incomes&expences
-                oper.append({
-                    'time': transaction['time'],
-                    'card': values.group(1),
-                    'time1': date_parse(values.group(2), default=transaction['time'], dayfirst=True),
-                    'oper': values.group(3),
-                    'sum': Decimal(values.group(4)),
-                    'currency': values.group(5),
-                    'comission': Decimal(values.group(6)) if values.group(6) else None,
-                    'commcurr': values.group(7),
-                    'place': values.group(8),
-                    'bal': Decimal(values.group(9))
-                })
-                continue
-            values = mobilebank_re.match(transaction['body'])
-            if values: # Mobile bank fees
-                oper.append({
-                    'time': transaction['time'],
-                    'card': values.group(1),
-                    'time1': date_parse(values.group(2), default=transaction['time'], dayfirst=True),
-                    'oper': values.group(3),
-                    'sum': Decimal(values.group(4)),
-                    'currency': values.group(5),
-                    'comission': None,
-                    'commcurr': None,
-                    'place': None,
-                    'bal': Decimal(values.group(6))
-                })
-                continue
-            values = transfer_re.match(transaction['body'])
-            if values: # Money transfers - old style, sender
-                trf.append({
-                    'time': transaction['time'],
-                    'name': values.group(1),
-                    'sum': Decimal(values.group(2)),
-                    'currency': values.group(3),
-                    'comment': values.group(4)
-                })
-                continue
-            values = receive_re.match(transaction['body'])
-            if values: #
-                trf.append({
-                    'time': transaction['time'],
-                    'name': values.group(6),
-                    'sum': Decimal(values.group(4)),
-                    'currency': values.group(5),
-                    'comment': values.group(7)
-                })
-                continue
-            if warn:
-                print("WARNING: unknown transaction")
-                pprint.pprint(transaction)
-        except:
-            print("ERROR: unable to process")
-            pprint.pprint(transaction)
+    :return: tuple of (operations, transfers), see process_sms_list
+    """
+    return rules.parse_sms_list(trans_list, warn)
 
-    for o in oper:
-        if o['oper'] == 'зачисление':
-            o['transfer'] = find_transfer(o, trf)
+
+def process_sms_list(trans_list, warn=False, unique_transfers=False):
+    """
+    Make list of operations from list of SMS
+    :param warn: print warnings
+    :param unique_transfers: attach every transfer to one operation at most
+    :param trans_list: list of transactions as dicts with 'time' and 'body' keys
+    :return: tuple of (operations, transfers), operations as list of records.Operation,
+            transfers as list of records.Transfer
+    """
+    oper, trf = parse_sms_list(trans_list, warn)
+    match_transfers(oper, trf, unique_transfers)
 
     return oper, trf
 
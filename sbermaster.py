@@ -1,54 +1,699 @@
 #!/usr/local/bin/python3
 
-import imaplib, getpass, email, pprint, argparse, sys, ssl
-import sberbank, vestabank, vtbbank
+import imaplib, getpass, email, pprint, argparse, sys, ssl, re, itertools, base64, binascii, quopri, threading, time
+import importlib, cProfile, tracemalloc, select
+import banks, rules, writers, sources, analytics
 
 from email import policy as pl
-from openpyxl import Workbook
-from dateutil.parser import parse as date_parse
+from dates import parse_header
+from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from msgstore import MessageStore
+from stats import STATS
+
+FETCH_BATCH = 200 # messages per UID FETCH command
+FETCH_FULL = '(RFC822)'
+FETCH_LEAN = '(UID BODY.PEEK[HEADER.FIELDS (DATE CONTENT-TYPE CONTENT-TRANSFER-ENCODING)] BODY.PEEK[TEXT])'
+FETCH_SENDER = '(UID BODY.PEEK[HEADER.FIELDS (DATE FROM CONTENT-TYPE CONTENT-TRANSFER-ENCODING)] BODY.PEEK[TEXT])'
+RETRIES = 3 # attempts to log in or to fetch a batch over the pool
+PARSE_CHUNK = 1000 # messages per task of parse_parallel
+IDLE_TIMEOUT = 25 * 60 # IDLE is renewed before servers drop it (RFC 2177 allows 30 minutes)
+MAX_BACKOFF = 300 # longest pause between reconnects of --watch, seconds
+
+
+def connect(site, login, password, folder):
+    """
+    Open IMAP session and select folder
+    :param site: IMAP server
+    :param login: login name
+    :param password: password
+    :param folder: folder to select
+    :return: mailbox reader object
+    :raise: imaplib.IMAP4.error if login fails or folder can't be selected, message tells which
+    """
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    mb_reader = imaplib.IMAP4_SSL(site, ssl_context=context)
+    try:
+        mb_reader.login(login, password)
+    except imaplib.IMAP4.error as e:
+        raise imaplib.IMAP4.error("Login failed " + str(e))
+
+    rv, data = mb_reader.select(folder)
+    if rv != 'OK':
+        mb_reader.logout()
+        raise imaplib.IMAP4.error("Unable to open mailbox " + folder)
+
+    return mb_reader
+
+
+def quote(value):
+    """
+    :return: value as IMAP quoted string
+    """
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
 
-def process_mailbox(mb_reader, s=r"(SINCE 1-Mar-2017 FROM 900)", stop_words=lambda x: True):
+def server_exclusion(mb_reader, phrases):
     """
-    Search messages from Sberbank in mailbox    
+    SEARCH keys dropping messages that contain any of the phrases, so noise is not fetched at all.
+    Gmail gets single X-GM-RAW query, other servers get NOT BODY keys. imaplib sends one literal
+    per command, so only the first non-ASCII phrase goes to non-Gmail servers
     :param mb_reader: mailbox reader object
-    :param s: search string in IMAP format
-    :return: messages as list of dicts {'time':headers, 'body':body}, time is datetime object, body is a string
+    :param phrases: lowercase phrases
+    :return: tuple (charset or None, search keys, literal as bytes or None), literal is the value of the last key
     """
+    if not phrases:
+        return None, "", None
+
+    if 'X-GM-EXT-1' in mb_reader.capabilities:
+        query = " ".join("-" + quote(p) for p in phrases)
+        if query.isascii():
+            return None, "X-GM-RAW " + quote(query), None
+        return 'UTF-8', "X-GM-RAW", query.encode('utf-8')
+
+    keys = " ".join("NOT BODY " + quote(p) for p in phrases if p.isascii())
+    other = [p for p in phrases if not p.isascii()]
+    if not other:
+        return None, keys, None
+    return 'UTF-8', (keys + " NOT BODY").lstrip(), other[0].encode('utf-8')
 
-    sms_list = []
 
+def search_uids(mb_reader, s, exclude=()):
+    """
+    Search messages in selected folder
+    :param mb_reader: mailbox reader object
+    :param s: search string in IMAP format
+    :param exclude: lowercase phrases, messages containing them are dropped by server if it accepts the keys
+            (plain search is repeated if not), client filter must still check every message
+    :return: list of message UIDs as bytes, empty if nothing found
+    """
     print("Searching...")
-    rv, data = mb_reader.search(None, s)
-    if rv != 'OK':
-        print("No messages found!")
-        return sms_list
+    with STATS.timer('search') as timer:
+        rv, data = 'NO', None
+        charset, keys, literal = server_exclusion(mb_reader, exclude)
+        if keys:
+            try:
+                mb_reader.literal = literal
+                args = ('CHARSET', charset) if charset else () # As IMAP4.search sends it
+                rv, data = mb_reader.uid('SEARCH', *args, s + " " + keys)
+            except imaplib.IMAP4.error as e:
+                rv, data = 'NO', [str(e)]
+            mb_reader.literal = None
+            if rv != 'OK':
+                print("WARNING: server rejected search filter, all messages are fetched", data)
+        if rv != 'OK':
+            rv, data = mb_reader.uid('SEARCH', None, s)
+        if rv != 'OK' or not data or not data[0]:
+            print("No messages found!")
+            return []
+        uids = data[0].split()
+        timer.items = len(uids)
+
+    return uids
+
+
+def parse_fetch_response(data):
+    """
+    Split FETCH response into messages
+    :param data: FETCH response data from imaplib
+    :return: generator of tuples (uid, raw message as bytes), header and text sections are joined
+    """
+    uid, raw = None, b''
+    for m in data:
+        if isinstance(m, tuple):
+            head = m[0]
+            if re.match(rb'[0-9]+ \(', head): # Next message starts
+                if raw:
+                    yield uid, raw
+                uid, raw = None, b''
+            if b'TEXT]' in head and raw and not raw.endswith(b'\r\n\r\n'):
+                raw += b'\r\n'
+            raw += m[1]
+        else:
+            head = m
+        value = re.search(rb'UID ([0-9]+)', head)
+        if value:
+            uid = int(value.group(1))
+    if raw:
+        yield uid, raw
 
-    mset = ""
-    for d in data[0].split():
-        mset = mset + "," + d.decode('ascii')
 
+def uid_span(mset):
+    """
+    :param mset: message set of UIDs separated by commas
+    :return: 'UID first:last' for messages
+    """
+    return "UID " + mset.partition(",")[0] + ":" + mset.rpartition(",")[2]
+
+
+def fetch_messages(mb_reader, uids, batch_size=FETCH_BATCH, items=FETCH_LEAN):
+    """
+    Fetch messages in bounded UID batches
+    :param mb_reader: mailbox reader object
+    :param uids: list of message UIDs
+    :param batch_size: number of messages per FETCH command
+    :param items: FETCH_LEAN for Date header and text only, FETCH_FULL for whole messages
+    :return: generator of tuples (uid, raw message as bytes)
+    :raise: imaplib.IMAP4.error if server doesn't return a batch, statement without it would be wrong
+    """
     print("Fetching...")
-    rv, data = mb_reader.fetch(mset, '(RFC822)')
-    if rv != 'OK':
-        print("ERROR: cannot get message")
-        return sms_list
+    for start in range(0, len(uids), batch_size):
+        mset = b",".join(uids[start:start + batch_size]).decode('ascii')
+        with STATS.timer('fetch') as timer:
+            rv, data = mb_reader.uid('FETCH', mset, items)
+            if rv != 'OK':
+                raise imaplib.IMAP4.error("cannot get messages " + uid_span(mset) + ": " + str(data))
+            messages = list(parse_fetch_response(data))
+            timer.items, timer.bytes = len(messages), sum(len(m[1]) for m in messages)
+        yield from messages
+
+
+class FetchPool:
+    """
+    Pool of logged in sessions with selected folder, fetches UID batches in parallel threads
+    """
+
+    def __init__(self, connect, connections=4):
+        """
+        :param connect: function without arguments that returns new selected mailbox reader
+        :param connections: number of sessions
+        """
+        self.connect = connect
+        self.connections = connections
+        self.folder = None # Folder to select instead of the one selected by connect
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sessions = []
+        # Threads live as long as the pool, so their sessions are reused by every folder
+        self.executor = ThreadPoolExecutor(connections)
+
+    def session(self):
+        """
+        Session of current thread, opened on first use
+        :return: mailbox reader object
+        """
+        if getattr(self.local, 'mb_reader', None) is None:
+            for attempt in range(RETRIES):
+                try:
+                    self.local.mb_reader = self.connect()
+                    self.local.folder = None
+                    break
+                except (imaplib.IMAP4.error, OSError):
+                    if attempt == RETRIES - 1:
+                        raise
+                    time.sleep(attempt + 1)
+            with self.lock:
+                self.sessions.append(self.local.mb_reader)
+        if self.folder is not None and self.local.folder != self.folder:
+            rv, data = self.local.mb_reader.select(self.folder)
+            if rv != 'OK':
+                raise imaplib.IMAP4.error("Unable to open mailbox " + self.folder)
+            self.local.folder = self.folder
+        return self.local.mb_reader
+
+    def select(self, folder):
+        """
+        Switch pool to another folder, every session selects it before its next fetch
+        :param folder: folder name
+        """
+        self.folder = folder
+
+    def drop(self):
+        """
+        Forget broken session of current thread
+        """
+        mb_reader, self.local.mb_reader = getattr(self.local, 'mb_reader', None), None
+        if mb_reader is None:
+            return
+        with self.lock:
+            self.sessions.remove(mb_reader)
+        try:
+            mb_reader.shutdown()
+        except OSError:
+            pass
+
+    def fetch_batch(self, mset, items):
+        """
+        Fetch one batch, reconnects and retries if session is dropped
+        :param mset: message set of UIDs
+        :param items: FETCH items
+        :return: list of tuples (uid, raw message as bytes) in UID order
+        """
+        for attempt in range(RETRIES):
+            try:
+                mb_reader = self.session()
+                with STATS.timer('fetch') as timer:
+                    rv, data = mb_reader.uid('FETCH', mset, items)
+                    if rv == 'OK':
+                        messages = sorted(parse_fetch_response(data), key=lambda m: m[0] or 0)
+                        timer.items, timer.bytes = len(messages), sum(len(m[1]) for m in messages)
+                if rv == 'OK':
+                    return messages
+            except (imaplib.IMAP4.abort, OSError):
+                self.drop()
+                time.sleep(attempt + 1)
+        raise imaplib.IMAP4.error("cannot get messages " + uid_span(mset))
+
+    def fetch(self, uids, batch_size=FETCH_BATCH, items=FETCH_LEAN):
+        """
+        Fetch messages in bounded UID batches over the pool, same result as fetch_messages
+        :param uids: list of message UIDs
+        :param batch_size: number of messages per FETCH command
+        :param items: FETCH_LEAN for Date header and text only, FETCH_FULL for whole messages
+        :return: generator of tuples (uid, raw message as bytes) in UID order
+        :raise: imaplib.IMAP4.error if a batch can't be fetched after retries
+        """
+        print("Fetching...")
+        uids = sorted(uids, key=int)
+        batches = (b",".join(uids[start:start + batch_size]).decode('ascii') for start in range(0, len(uids), batch_size))
+        pending = deque() # Bounded number of batches in flight keeps memory flat
+        try:
+            for mset in batches:
+                pending.append(self.executor.submit(self.fetch_batch, mset, items))
+                if len(pending) >= self.connections * 2:
+                    yield from self.wait(pending.popleft())
+            while pending:
+                yield from self.wait(pending.popleft())
+        finally:
+            for f in pending: # Batches of abandoned or failed folder are not fetched
+                f.cancel()
+
+    @staticmethod
+    def wait(future):
+        """
+        Result of fetch_batch, time spent waiting for it is counted as 'fetch wait' stage
+        """
+        with STATS.timer('fetch wait'):
+            return future.result()
+
+    def close(self):
+        """
+        Stop pool threads and log out all sessions
+        """
+        self.executor.shutdown()
+        for mb_reader in self.sessions:
+            try:
+                close_session(mb_reader)
+            except (imaplib.IMAP4.error, OSError):
+                pass
+        self.sessions = []
+
+
+def text_filter(stop_words):
+    """
+    Make text check from message filter, so messages can be dropped before records are made
+    :param stop_words: StopWords object or function of dict with 'body' key
+    :return: function of SMS text, False if message must be dropped
+    """
+    return STATS.timed('filter', getattr(stop_words, 'check', lambda text: stop_words({'body': text})))
 
-    msg_list = []
-    for m in data:
-        if len(m) > 1:
-            msg_list.append(m[1])
 
-    print("Processing...")
+def parse_message(msg_bytes, accept=None, sender=False):
+    """
+    Decode raw message to SMS records with full MIME parser. Every text/plain part of multipart message
+    is a record, other text parts (HTML copy of multipart/alternative) are taken only if there is no plain one
+    :param msg_bytes: raw message as bytes
+    :param accept: text check, message is dropped if it returns False
+    :param sender: add 'sender' key with From header
+    :return: list of dicts {'time':headers, 'body':body}, time is datetime object, body is a string;
+            empty if message has no Date header
+    """
+    msg = email.message_from_bytes(msg_bytes, policy=pl.default)
+    if msg['Date'] is None: # Parts have no Date of their own
+        print("WARNING: message without Date header is skipped")
+        return []
+    parts = [part for part in msg.walk() if not part.is_multipart() and part.get_content_maintype() == 'text']
+    records = []
+    for part in [part for part in parts if part.get_content_subtype() == 'plain'] or parts:
+        try:
+            body = part.get_content()
+        except LookupError: # Unknown charset
+            body = part.get_payload(decode=True).decode('utf-8', 'replace')
+        if accept is None or accept(body):
+            records.append({'time': parse_header(str(msg['Date'])), 'body': body})
+            if sender:
+                records[-1]['sender'] = str(msg.get('From', ''))
+    return records
+
+
+def decode_message(msg_bytes, accept=None, sender=False):
+    """
+    Decode raw message to SMS records. Single part text messages (all SMS Backup+ messages)
+    are decoded without building message tree, the rest goes to parse_message
+    :param msg_bytes: raw message as bytes
+    :param accept: text check, message is dropped before its Date header is parsed if it returns False
+    :param sender: add 'sender' key with From header (FETCH_SENDER or FETCH_FULL fetches it)
+    :return: list of dicts {'time':headers, 'body':body}, time is datetime object, body is a string
+    """
+    eol = b'\r\n' if msg_bytes[:msg_bytes.find(b'\n') + 1].endswith(b'\r\n') else b'\n' # mbox files use LF
+    head, sep, body = msg_bytes.partition(eol + eol)
+    if not sep:
+        return parse_message(msg_bytes, accept, sender)
+
+    headers = {}
+    for line in re.sub(eol + rb'[ \t]+', b' ', head).split(eol): # Unfold and split headers
+        name, colon, value = line.partition(b':')
+        if colon:
+            headers.setdefault(name.strip().lower(), value.strip())
+
+    ctype = headers.get(b'content-type', b'text/plain')
+    cte = headers.get(b'content-transfer-encoding', b'7bit').lower()
+    charset = re.search(rb'charset="?([^";\s]+)', ctype, re.IGNORECASE)
+    if b'date' not in headers or ctype.split(b';')[0].strip().lower() != b'text/plain':
+        return parse_message(msg_bytes, accept, sender)
+
+    try:
+        if cte == b'base64':
+            body = base64.b64decode(b''.join(body.splitlines()), validate=True)
+        elif cte == b'quoted-printable':
+            body = quopri.decodestring(body)
+        elif cte not in (b'7bit', b'8bit', b'binary'):
+            return parse_message(msg_bytes, accept, sender)
+        text = body.decode(charset.group(1).decode('ascii') if charset else 'ascii', 'replace')
+    except (binascii.Error, LookupError, UnicodeError):
+        return parse_message(msg_bytes, accept, sender)
+
+    if accept is not None and not accept(text):
+        return []
+    record = {'time': parse_header(headers[b'date'].decode('ascii', 'replace')), 'body': text}
+    if sender:
+        record['sender'] = headers.get(b'from', b'').decode('utf-8', 'replace')
+    return [record]
+
+
+def decode_messages(raw_messages, accept=None, sender=False):
+    """
+    Decode raw messages to SMS records
+    :param raw_messages: iterable of tuples (uid, raw message as bytes), dicts {'time', 'body'}
+            that are already decoded are only checked with accept
+    :param accept: text check, message is dropped if it returns False
+    :param sender: add 'sender' key with From header
+    :return: generator of dicts {'time':headers, 'body':body}, time is datetime object, body is a string
+    """
     counter = 0
-    for msg_bytes in msg_list:
-        msg = email.message_from_bytes(msg_bytes, policy=pl.default)
-        for part in msg.walk(): # Parse message
-            sms_list.append({'time': date_parse(dict(part.items())['Date']), 'body': part.get_content()})
+    decode = STATS.timed('decode', decode_message)
+    for item in raw_messages:
+        if isinstance(item, dict):
+            if accept is None or accept(item['body']):
+                yield item
+        else:
+            yield from decode(item[1], accept, sender)
         counter += 1
         if counter % 100 == 0: # Make some awaiting progress
             print("Processed ", counter, "messages")
 
-    return list(filter(stop_words, sms_list))
+
+def process_mailbox(mb_reader, s=r"(SINCE 1-Mar-2017 FROM 900)", stop_words=lambda x: True, batch_size=FETCH_BATCH,
+                    items=FETCH_LEAN, pool=None, raw=False, sender=False, exclude=()):
+    """
+    Search messages from Sberbank in mailbox
+    Messages are fetched batch by batch while the result is consumed, so memory usage
+    doesn't depend on mailbox size
+    :param mb_reader: mailbox reader object
+    :param s: search string in IMAP format
+    :param stop_words: StopWords object or filter function, message is dropped while decoding if it returns False
+    :param batch_size: number of messages per FETCH command
+    :param items: FETCH_LEAN for Date header and text only, FETCH_FULL for whole messages
+    :param pool: FetchPool to fetch messages in parallel, mb_reader is used if none
+    :param raw: return messages undecoded and unfiltered for parse_parallel
+    :param sender: add 'sender' key with From header, items must fetch it (FETCH_SENDER)
+    :param exclude: phrases of messages that server may drop, see search_uids
+    :return: generator of dicts {'time':headers, 'body':body}, time is datetime object, body is a string
+            (tuples (uid, raw message as bytes) if raw)
+    """
+
+    uids = search_uids(mb_reader, s, exclude)
+    raw_messages = pool.fetch(uids, batch_size, items) if pool else fetch_messages(mb_reader, uids, batch_size, items)
+    return raw_messages if raw else decode_messages(raw_messages, text_filter(stop_words), sender)
+
+
+def close_session(mb_reader):
+    """
+    Close selected folder and log out, CLOSE is illegal if the last SELECT failed
+    :param mb_reader: mailbox reader object
+    """
+    if mb_reader.state == 'SELECTED':
+        mb_reader.close()
+    mb_reader.logout()
+
+
+def process_folders(mb_reader, folders, process, pool=None):
+    """
+    Read several folders over the same session one after another
+    :param mb_reader: mailbox reader object, the first folder must be selected
+    :param folders: list of folder names
+    :param process: function(folder) that returns messages of selected folder, e.g. process_mailbox
+    :param pool: FetchPool, its sessions are switched to every folder too
+    :return: generator of messages of all folders, folders that can't be selected are skipped
+            (session stays in AUTH state after failed SELECT, see close_session)
+    """
+    for n, folder in enumerate(folders):
+        if n:
+            rv, data = mb_reader.select(folder)
+            if rv != 'OK':
+                print("ERROR: Unable to open mailbox", folder)
+                continue
+            if pool:
+                pool.select(folder)
+        yield from process(folder)
+
+
+def sync_mailbox(mb_reader, store, folder, criteria, since, stop_words=lambda x: True, batch_size=FETCH_BATCH,
+                 items=FETCH_LEAN, pool=None, exclude=()):
+    """
+    Incrementally synchronize messages with local store, only messages above stored UID
+    are fetched from the server
+    :param mb_reader: mailbox reader object, folder must be selected
+    :param store: MessageStore object
+    :param folder: selected folder name
+    :param criteria: search string in IMAP format without date
+    :param since: start date in IMAP format (1-Mar-2018)
+    :param stop_words: filter function, message is dropped if it returns False
+    :param batch_size: number of messages per FETCH command
+    :param items: FETCH_LEAN for Date header and text only, FETCH_FULL for whole messages
+    :param pool: FetchPool to fetch messages in parallel, mb_reader is used if none
+    :param exclude: phrases of messages that server may drop, see search_uids. They are part of the store key:
+            messages dropped below stored UID would never be fetched if the phrases change
+    :return: generator of dicts {'time':headers, 'body':body}, stored messages first, then new ones
+    """
+    rv, data = mb_reader.response('UIDVALIDITY')
+    uidvalidity = int(data[0]) if data and data[0] else None
+    since_date = datetime.strptime(since, "%d-%b-%Y").date()
+    key = folder + " " + criteria + "".join(" NOT " + quote(p) for p in exclude)
+
+    last_uid = store.begin(key, uidvalidity, since_date)
+    s = "(" + criteria + " SINCE " + since + " UID " + str(last_uid + 1) + ":*)"
+    # n:* always matches the last message
+    uids = [u for u in search_uids(mb_reader, s, exclude) if int(u) > last_uid]
+
+    def new_records():
+        counter = 0
+        decode, add = STATS.timed('decode', decode_message), STATS.timed('store', store.add)
+        raw_messages = pool.fetch(uids, batch_size, items) if pool else fetch_messages(mb_reader, uids, batch_size, items)
+        for uid, msg_bytes in raw_messages:
+            records = decode(msg_bytes)
+            add(key, uid, records)
+            yield from records
+            counter += 1
+            if counter % 100 == 0: # Make some awaiting progress
+                print("Processed ", counter, "messages")
+        store.commit()
+
+    return filter(STATS.timed('filter', stop_words), itertools.chain(store.records(key, since_date), new_records()))
+
+
+def idle(mb_reader, timeout=IDLE_TIMEOUT):
+    """
+    Wait in IDLE state until server reports new message or timeout runs out (imaplib has no IDLE command)
+    :param mb_reader: mailbox reader object, folder must be selected
+    :param timeout: seconds to wait
+    :return: True if EXISTS response came, False on timeout
+    :raise: imaplib.IMAP4.abort if connection is closed, imaplib.IMAP4.error if server rejects IDLE
+    """
+    def response():
+        line = mb_reader.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("connection closed in IDLE")
+        return line
+
+    tag = mb_reader._new_tag()
+    mb_reader.send(tag + b" IDLE\r\n")
+    line = response()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error("IDLE rejected: " + line.decode('ascii', 'replace').strip())
+
+    def done():
+        mb_reader.send(b"DONE\r\n")
+        found = False
+        while True: # Responses that came before DONE, then completion of IDLE
+            line = response()
+            if line.startswith(tag + b" "):
+                return found
+            found = found or re.match(rb'\* [0-9]+ EXISTS', line) is not None
+
+    changed = False
+    deadline = time.monotonic() + timeout
+    sock = mb_reader.sock
+    try:
+        while not changed:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            # TLS layer may hold decrypted data select doesn't see
+            if not getattr(sock, 'pending', lambda: 0)() and not select.select([sock], [], [], left)[0]:
+                break
+            changed = re.match(rb'\* [0-9]+ EXISTS', response()) is not None
+    except KeyboardInterrupt: # Session leaves IDLE, so it can log out
+        done()
+        raise
+
+    return done() or changed
+
+
+def wait_for_changes(mb_reader, poll=60):
+    """
+    Wait until new messages may have come: IDLE if server supports it, NOOP after a pause if not
+    :param mb_reader: mailbox reader object, folder must be selected
+    :param poll: seconds between NOOP commands
+    """
+    if 'IDLE' in mb_reader.capabilities:
+        idle(mb_reader)
+    else:
+        time.sleep(poll)
+        mb_reader.noop()
+
+
+def watch_mailbox(open_session, criteria, since, stop_words=lambda x: True, items=FETCH_LEAN, sender=False,
+                  exclude=(), poll=60, mb_reader=None):
+    """
+    Follow selected folder: messages found by search first, then every new message as soon as server reports it.
+    Lost connection is opened again after growing pause, messages above the last seen UID are read then
+    :param open_session: function without arguments that returns new mailbox reader with selected folder
+    :param criteria: search string in IMAP format without date
+    :param since: start date in IMAP format (1-Mar-2018)
+    :param stop_words: StopWords object or filter function, message is dropped while decoding if it returns False
+    :param items: FETCH_LEAN for Date header and text only, FETCH_FULL for whole messages
+    :param sender: add 'sender' key with From header, items must fetch it (FETCH_SENDER)
+    :param exclude: phrases of messages that server may drop, see search_uids
+    :param poll: seconds between NOOP commands if server has no IDLE
+    :param mb_reader: already opened session to start with, the generator owns it then
+    :return: endless generator of lists of dicts {'time', 'body'}, the first list has all messages found by search;
+            None means UIDVALIDITY has changed and messages will be read again from the start
+    """
+    uidvalidity, last_uid, backoff, first = None, 0, 1, True
+    accept = text_filter(stop_words)
+    try:
+        while True:
+            try:
+                if mb_reader is None or uidvalidity is None: # New session, check that known UIDs are still valid
+                    mb_reader = mb_reader or open_session()
+                    rv, data = mb_reader.response('UIDVALIDITY')
+                    value = int(data[0]) if data and data[0] else None
+                    if uidvalidity is not None and value != uidvalidity: # Old UIDs mean nothing now
+                        print("WARNING: UIDVALIDITY has changed, reading folder again")
+                        last_uid, first = 0, True
+                        yield None
+                    uidvalidity = value
+
+                s = "(" + criteria + " SINCE " + since + (" UID " + str(last_uid + 1) + ":*)" if last_uid else ")")
+                # n:* always matches the last message
+                uids = [u for u in search_uids(mb_reader, s, exclude) if int(u) > last_uid]
+                if uids or first:
+                    raw_messages = list(fetch_messages(mb_reader, uids, items=items))
+                    messages = list(decode_messages(raw_messages, accept, sender))
+                    # Messages not fetched stay above the last UID and are searched again
+                    last_uid = max([uid for uid, raw in raw_messages if uid] + [last_uid])
+                    first = False
+                    yield messages
+                backoff = 1
+                wait_for_changes(mb_reader, poll)
+            except (imaplib.IMAP4.error, OSError) as e: # abort is a subclass of error
+                print("WARNING: connection lost (" + str(e) + "), reconnecting in", backoff, "seconds")
+                if mb_reader is not None:
+                    try:
+                        mb_reader.shutdown()
+                    except OSError:
+                        pass
+                mb_reader = None
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+    finally:
+        if mb_reader is not None:
+            try:
+                mb_reader.logout()
+            except (imaplib.IMAP4.error, OSError):
+                pass
+
+def parse_chunk(bank, chunk, warn=False, timing=False):
+    """
+    Worker of parse_parallel: decode and parse one chunk of messages
+    :param bank: bank module name or list of them, several banks are routed with banks.parse_sms_list
+    :param chunk: list of dicts {'time', 'body'} or tuples (uid, raw message as bytes)
+    :param warn: print warnings
+    :param timing: collect stage counters
+    :return: tuple (operations, transfers, list of rule counters of every bank, stage counters)
+    """
+    modules = [importlib.import_module(b) for b in ([bank] if isinstance(bank, str) else bank)]
+    STATS.enabled = timing
+    STATS.take() # Counters copied from parent process are not ours
+    several = len(modules) > 1
+    accept = text_filter((lambda x: True) if several else modules[0].stop_words) # Banks filter their own SMS
+    decode = STATS.timed('decode', decode_message)
+    sms_list = []
+    for item in chunk:
+        if isinstance(item, tuple):
+            sms_list.extend(decode(item[1], accept, several))
+        elif accept(item['body']):
+            sms_list.append(item)
+
+    with STATS.timer('parse') as timer:
+        oper, trf = banks.parse_sms_list(sms_list, modules, warn)
+        timer.items = len(oper) + len(trf)
+    return oper, trf, [m.rules.take_counters() for m in modules], STATS.take()
+
+
+def parse_parallel(messages, bank, jobs=2, warn=False, chunk_size=PARSE_CHUNK):
+    """
+    Decode and parse messages in worker processes, chunks are merged in original order.
+    Transfers are not attached to operations, it needs all messages at once
+    :param messages: iterable of dicts {'time', 'body'} or tuples (uid, raw message as bytes)
+            as returned by process_mailbox with raw=True
+    :param bank: bank module name or list of them
+    :param jobs: number of processes
+    :param warn: print warnings
+    :param chunk_size: number of messages per task
+    :return: tuple (operations, transfers), same as banks.parse_sms_list
+    """
+    modules = [importlib.import_module(b) for b in ([bank] if isinstance(bank, str) else bank)]
+    oper, trf = [], []
+    counter = 0
+    messages = iter(messages)
+    chunks = iter(lambda: list(itertools.islice(messages, chunk_size)), [])
+
+    def collect(future):
+        with STATS.timer('parse wait'):
+            o, t, counters, stage_counters = future.result()
+        oper.extend(o)
+        trf.extend(t)
+        for module, c in zip(modules, counters):
+            module.rules.add_counters(c)
+        STATS.merge(stage_counters)
+
+    with ProcessPoolExecutor(jobs) as executor:
+        pending = deque() # Bounded number of chunks in flight keeps memory flat
+        for chunk in chunks:
+            pending.append(executor.submit(parse_chunk, bank, chunk, warn, STATS.enabled))
+            counter += len(chunk)
+            if len(pending) >= jobs * 2:
+                collect(pending.popleft())
+                print("Processed ", counter, "messages")
+        while pending:
+            collect(pending.popleft())
+
+    return oper, trf
 
 
 def process_arguments():
@@ -62,136 +707,233 @@ def process_arguments():
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter
                                      )
     parser.add_argument("-d", "--date", help="Start from date", default="1-Mar-2018")
-    parser.add_argument("-l", "--login", help="Login with this name", required=True)
+    parser.add_argument("-l", "--login", help="Login with this name (required unless --source is given)")
     parser.add_argument("-p", "--password", help="Login with this password (prompt for password if none)")
     parser.add_argument("-s", "--site", help="Connect to this imap server", default="imap.gmail.com")
-    parser.add_argument("-f", "--folder", help="Folder/label to read SMS from", default="SMS")
-    parser.add_argument("-S", "--search", help="IMAP search string", default="FROM 900")
+    parser.add_argument("-f", "--folder", help="Folder/label to read SMS from, comma separated list for several "
+                                          "folders read over the same session", default="SMS")
+    parser.add_argument("-S", "--search", help="IMAP search string, bank's own if none (FROM 900 for sberbank)")
     parser.add_argument("-w", "--warn", help="Print warnings", action="store_true")
     parser.add_argument("-q", "--quiet", help="No print at all", action="store_true")
-    parser.add_argument("-b", "--bank", help="'sberbank' | 'vesta' | 'vtb' (also changes search string)", default="sberbank")
-    parser.add_argument("outfile", help="Output MS Excel file, please add .xlsx explicitly, \
-                         if none print SMS list and stop", nargs="?", default=None)
+    parser.add_argument("--full-fetch", help="Fetch whole messages instead of Date header and text",
+                        action="store_true")
+    parser.add_argument("-n", "--connections", help="Fetch over this number of parallel IMAP sessions",
+                        type=int, default=1)
+    parser.add_argument("-j", "--jobs", help="Decode and parse messages in this number of processes",
+                        type=int, default=1)
+    parser.add_argument("--source", help="Read local archive instead of IMAP server: mbox:PATH | maildir:PATH | "
+                                         "smsxml:PATH (all messages are read, date and search are not used, "
+                                         "SMS of XML backup are taken from bank senders only)")
+    parser.add_argument("--client-filter", help="Filter messages on client only, server search doesn't drop noise "
+                                                "SMS of the bank", action="store_true")
+    parser.add_argument("-c", "--cache", help="Local message store (SQLite) for incremental sync")
+    parser.add_argument("--watch", help="Keep the folder open and parse new SMS as they come (IDLE, NOOP polling if "
+                                        "server has no IDLE), outfile is saved again after every new message, "
+                                        "Ctrl-C stops", action="store_true")
+    parser.add_argument("--poll", help="Seconds between NOOP polls of --watch if server has no IDLE",
+                        type=int, default=60)
+    parser.add_argument("-u", "--unique-transfers", help="Attach every transfer to one operation at most (sberbank)",
+                        action="store_true")
+    parser.add_argument("-b", "--bank", help="'sberbank' | 'vesta' | 'vtb' or bank from installed package "
+                                           "(also changes search string), comma separated list for several banks, "
+                                           "every message goes to the bank of its sender and text",
+                        default="sberbank")
+    parser.add_argument("--sheets", help="Operations table (sheet) per bank or per card, per bank if there are "
+                                         "several banks", choices=("bank", "card"))
+    parser.add_argument("--stats", help="Print time and item counts of every stage and rule counters",
+                        action="store_true")
+    parser.add_argument("--stats-format", help="Format of --stats report: summary table or JSON line",
+                        choices=("table", "json"), default="table")
+    parser.add_argument("--profile", help="Profile the run with cProfile and dump stats to this file "
+                                          "(python -m pstats FILE)")
+    parser.add_argument("--trace-memory", help="Trace allocations with tracemalloc, peak and top allocations are "
+                                               "added to --stats report", action="store_true")
+    parser.add_argument("--summary", help="Add summary tables (sheets): totals per card, month, place and "
+                                          "operation, monthly balances and balance gaps (missed SMS)",
+                        action="store_true")
+    parser.add_argument("--append", help="Append only operations that are not in outfile yet and fill transfers "
+                                         "matched later into rows written before (csv, jsonl and sqlite), "
+                                         "rows are tracked by card, time, sum and balance", action="store_true")
+    parser.add_argument("-F", "--format", help="Output format, guessed by outfile extension if none",
+                        choices=sorted(writers.WRITERS))
+    parser.add_argument("outfile", help="Output MS Excel file, please add .xlsx explicitly (.csv, .jsonl and .sqlite \
+                         are supported too), if none print SMS list and stop", nargs="?", default=None)
 
     prog_arguments = vars(parser.parse_args())
-
-    if prog_arguments['bank'] == "vesta" and prog_arguments['search'] == "FROM 900":
-        prog_arguments['search'] = "FROM VestaBank"
-    if prog_arguments['bank'] == 'vtb' and prog_arguments['search'] == 'FROM 900':
-        prog_arguments['search'] = "FROM VTB"
+    if not prog_arguments['login'] and not prog_arguments['source']:
+        parser.error("the following arguments are required: -l/--login")
+    if prog_arguments['watch'] and (prog_arguments['source'] or prog_arguments['cache']
+                                    or "," in prog_arguments['folder']):
+        parser.error("--watch follows one IMAP folder, --source, --cache and folder lists can't be used with it")
 
     return prog_arguments
 
 
-def save_operations(arg, wb_file='sbercards.xlsx'):
+def watch_operations(batches, modules, config_opts, group=None):
     """
-    Save operations to xlsx
+    Parse messages of watch_mailbox as they come and save all operations after every batch with new ones
+    :param batches: generator of lists of messages from watch_mailbox
+    :param modules: list of bank modules
+    :param config_opts: dict of configuration options
+    :param group: None for single Operations table, 'bank' or 'card' for table (sheet) per bank or card
+    :return: None, runs until interrupted
+    """
+    oper, trf = [], []
+    for sms_list in batches:
+        if sms_list is None: # Folder is read again from the start
+            oper, trf = [], []
+            continue
+        if not config_opts['outfile']:
+            for sms in sms_list:
+                pprint.pprint(sms)
+            continue
+
+        with STATS.timer('parse') as timer:
+            new_oper, new_trf = banks.parse_sms_list(sms_list, modules, warn=config_opts['warn'])
+            timer.items = len(new_oper) + len(new_trf)
+        if not new_oper and not new_trf:
+            continue
+        oper.extend(new_oper)
+        trf.extend(new_trf)
+        if any(hasattr(m, 'match_transfers') for m in modules): # Transfer SMS may come after its operation
+            with STATS.timer('transfers', len(oper)):
+                banks.match_transfers(oper, trf, modules, config_opts['unique_transfers'])
+        save_operations((oper, trf), wb_file=config_opts['outfile'], fmt=config_opts['format'], group=group,
+                        summary=config_opts['summary'], append=config_opts['append'])
+        print("Saved", len(new_oper), "new operations and", len(new_trf), "new transfers,", len(oper), "operations "
+              "total")
+
+
+def save_operations(arg, wb_file='sbercards.xlsx', fmt=None, group=None, summary=False, append=False):
+    """
+    Save operations to xlsx or another format
     :param arg: tuple of (oper, trf), oper is a list of transactions as sms-es
             trf is a list of transfers as sms-es
     :param wb_file: write to this file
+    :param fmt: 'xlsx' | 'csv' | 'jsonl' | 'sqlite', guessed by wb_file extension if none
+    :param group: None for single Operations table, 'bank' or 'card' for table (sheet) per bank or card
+    :param summary: add summary tables (sheets) of analytics module: totals per card, month, place and operation,
+            running balances and balance gaps
+    :param append: write only operations that are not in wb_file yet and operations with transfer matched
+            since the last run (not for xlsx)
     :return: None
     """
 
     oper, trf = arg
-
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Operations"
-
-    # Initialize columns
-    cur_col = 1
-    for val in ("Card", "Time", "Time in SMS", "Operation", "Sum", "Currency",
-                "Comission", "Comm. currency", "Balance", "Place",
-                "Name", "Comment", "Time of transfer"
-               ):
-        ws.cell(row=1, column=cur_col, value=val)
-        cur_col += 1
-
-    cur_row = 2
-    for o in oper:
-        ws.cell(row=cur_row, column=1, value=o['card'])
-        ws.cell(row=cur_row, column=2, value=o['time'])
-        ws.cell(row=cur_row, column=3, value=o['time1'])
-        ws.cell(row=cur_row, column=4, value=o['oper'])
-        ws.cell(row=cur_row, column=5, value=o['sum'])
-        ws.cell(row=cur_row, column=6, value=o['currency'])
-        ws.cell(row=cur_row, column=7, value=o['comission'])
-        ws.cell(row=cur_row, column=8, value=o['commcurr'])
-        ws.cell(row=cur_row, column=9, value=o['bal'])
-        ws.cell(row=cur_row, column=10, value=o['place'])
-        if ('transfer' not in o.keys()) or ('transfer' in o.keys() and o['transfer'] == 'Not found'):
-            ws.cell(row=cur_row, column=11, value="")
-            ws.cell(row=cur_row, column=12, value="")
-            ws.cell(row=cur_row, column=13, value="")
-        else:
-            ws.cell(row=cur_row, column=11, value=o['transfer']['name'])
-            ws.cell(row=cur_row, column=12, value=o['transfer']['comment'])
-            ws.cell(row=cur_row, column=13, value=o['transfer']['time'])
-        cur_row += 1
-
-    if trf:
-        ws1 = wb.create_sheet("Transfers")
-
-        # Initialize columns
-        cur_col = 1
-        for val in ('Time', 'Name', 'Sum', 'Comment'):
-            ws1.cell(row=1, column=cur_col, value=val)
-            cur_col += 1
-
-        cur_row = 2
-        for transaction in trf:
-            ws1.cell(row=cur_row, column=1, value=transaction['time'])
-            ws1.cell(row=cur_row, column=2, value=transaction['name'])
-            ws1.cell(row=cur_row, column=3, value=transaction['sum'])
-            ws1.cell(row=cur_row, column=4, value=transaction['comment'])
-            cur_row += 1
-
-    wb.save(wb_file)
+    extra = []
+    if summary:
+        with STATS.timer('analytics', len(oper)):
+            extra = analytics.summary_tables(oper)
+    with STATS.timer('save', len(oper) + len(trf)):
+        writers.save(oper, trf, wb_file, fmt, group, extra, append)
 
 if __name__ == "__main__":
 
     config_opts = process_arguments()
 
-    if config_opts['bank'] == "vesta":
-        process_sms_list = vestabank.process_sms_list
-        stop_words = vestabank.stop_words
-    elif config_opts['bank'] == "vtb":
-        process_sms_list = vtbbank.process_sms_list
-        stop_words = vtbbank.stop_words
-    elif config_opts['bank'] == "sberbank":
-        process_sms_list = sberbank.process_sms_list
-        stop_words = sberbank.stop_words
-    else:
-        print("ERROR: Unknown bank", config_opts['bank'])
-        sys.exit(1)
-
-    context = ssl.create_default_context()
-    context.check_hostname = False
-    context.verify_mode = ssl.CERT_NONE
-    mb_reader = imaplib.IMAP4_SSL(config_opts['site'], ssl_context=context)
+    STATS.enabled = bool(config_opts['stats'])
+    if config_opts['trace_memory']:
+        tracemalloc.start()
+    profiler = cProfile.Profile() if config_opts['profile'] else None
+    if profiler:
+        profiler.enable()
 
     try:
-        rv, data = mb_reader.login(config_opts['login'],
-                                   config_opts['password'] if config_opts['password'] else getpass.getpass()
-                                   )
-    except imaplib.IMAP4.error:
-        print("ERROR: Login failed")
+        modules = [banks.load(name.strip()) for name in config_opts['bank'].split(",")]
+    except ValueError as e:
+        print("ERROR:", e)
         sys.exit(1)
-
-    rv, data = mb_reader.select(config_opts['folder'])
-    if rv == 'OK':
-        search_string = "(" + config_opts['search'] + " SINCE " + config_opts['date'] + ")"
-        sms_list = process_mailbox(mb_reader, search_string, stop_words)
-        mb_reader.close()
+    several = len(modules) > 1
+    stop_words = (lambda x: True) if several else modules[0].stop_words # Banks filter their own SMS then
+    if not config_opts['search']:
+        config_opts['search'] = banks.search_string(modules)
+    folders = [f.strip() for f in config_opts['folder'].split(",")]
+    exclude = () if config_opts['client_filter'] else banks.server_exclude(modules)
+
+    parallel = config_opts['outfile'] and config_opts['jobs'] > 1
+    mb_reader = pool = None
+    if config_opts['source']:
+        try:
+            sms_list = sources.read_source(config_opts['source'], banks.senders(modules))
+        except ValueError as e:
+            print("ERROR:", e)
+            sys.exit(1)
+        if not parallel:
+            sms_list = decode_messages(sms_list, text_filter(stop_words), several)
     else:
-        print("ERROR: Unable to open mailbox ", rv)
-        sys.exit(1)
+        if not config_opts['password']:
+            config_opts['password'] = getpass.getpass()
+        open_session = STATS.timed('login', lambda: connect(config_opts['site'], config_opts['login'],
+                                                            config_opts['password'], folders[0]))
+
+        try:
+            mb_reader = open_session()
+        except imaplib.IMAP4.error as e:
+            print("ERROR:", e)
+            sys.exit(1)
+
+        pool = FetchPool(open_session, config_opts['connections']) \
+            if config_opts['connections'] > 1 and not config_opts['watch'] else None
+        fetch_items = FETCH_FULL if config_opts['full_fetch'] else FETCH_SENDER if several else FETCH_LEAN
+        if config_opts['watch']:
+            sms_list = watch_mailbox(open_session, config_opts['search'], config_opts['date'], stop_words,
+                                     fetch_items, several, exclude, config_opts['poll'], mb_reader)
+            mb_reader = None # Session belongs to the watcher now
+        elif config_opts['cache']:
+            store = MessageStore(config_opts['cache'])
+            process = lambda folder: sync_mailbox(mb_reader, store, folder, config_opts['search'],
+                                                  config_opts['date'], stop_words, items=fetch_items, pool=pool,
+                                                  exclude=exclude)
+        else:
+            search_string = "(" + config_opts['search'] + " SINCE " + config_opts['date'] + ")"
+            process = lambda folder: process_mailbox(mb_reader, search_string, stop_words, items=fetch_items,
+                                                     pool=pool, raw=parallel, sender=several, exclude=exclude)
+        if not config_opts['watch']:
+            sms_list = process_folders(mb_reader, folders, process, pool)
 
-    if sms_list:
-        if config_opts['outfile']:
-            save_operations((process_sms_list(sms_list, warn=config_opts['warn'])), wb_file=config_opts['outfile'])
+    failed = False
+    try:
+        if config_opts['watch']:
+            try:
+                watch_operations(sms_list, modules, config_opts,
+                                 config_opts['sheets'] or ('bank' if several else None))
+            except KeyboardInterrupt:
+                sms_list.close()
+                print("Stopped")
+        elif config_opts['outfile']:
+            if parallel:
+                oper, trf = parse_parallel(sms_list, [m.__name__ for m in modules], config_opts['jobs'],
+                                           warn=config_opts['warn'])
+            else:
+                with STATS.timer('parse') as timer: # Fetch and decode of the messages are counted on their own
+                    oper, trf = banks.parse_sms_list(sms_list, modules, warn=config_opts['warn'])
+                    timer.items = len(oper) + len(trf)
+            if any(hasattr(m, 'match_transfers') for m in modules):
+                with STATS.timer('transfers', len(oper)):
+                    banks.match_transfers(oper, trf, modules, config_opts['unique_transfers'])
+            if oper or trf:
+                save_operations((oper, trf), wb_file=config_opts['outfile'], fmt=config_opts['format'],
+                                group=config_opts['sheets'] or ('bank' if several else None),
+                                summary=config_opts['summary'], append=config_opts['append'])
+            if config_opts['warn']: # Which SMS formats are live
+                for table in rules.TABLES.values():
+                    pprint.pprint(table.stats())
         else:
             for sms in sms_list:
                 pprint.pprint(sms)
-
-    mb_reader.logout()
+    except imaplib.IMAP4.error as e: # Messages are missing, outfile is left as it was
+        print("ERROR:", e)
+        failed = True
+
+    if pool:
+        pool.close()
+    if mb_reader:
+        close_session(mb_reader)
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(config_opts['profile'])
+    if config_opts['stats']:
+        STATS.dump(config_opts['stats_format'], [m.rules for m in modules])
+    if failed:
+        sys.exit(1)
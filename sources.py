@@ -0,0 +1,110 @@
+#!/usr/local/bin/python3
+
+import os, mmap
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+
+def map_file(path):
+    """
+    Memory-map file for reading
+    :param path: file name
+    :return: mmap object, None if file is empty
+    """
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def mbox_messages(path):
+    """
+    Read messages from mbox file. The file is memory-mapped and scanned for 'From ' lines,
+    only the current message is copied
+    :param path: mbox file name
+    :return: generator of tuples (number, raw message as bytes)
+    """
+    mm = map_file(path)
+    if mm is None:
+        return
+
+    with mm:
+        number = 0
+        start = 0 if mm[:5] == b'From ' else mm.find(b'\nFrom ')
+        while start != -1:
+            start = mm.find(b'\n', start + 1) + 1 # Skip 'From ' line
+            if not start:
+                break
+            end = mm.find(b'\nFrom ', start)
+            number += 1
+            yield number, mm[start:end + 1 if end != -1 else len(mm)]
+            start = end
+
+
+def maildir_messages(path):
+    """
+    Read messages from Maildir, every message is a small file of its own so it's read as a whole
+    :param path: Maildir directory, with cur and new subdirectories
+    :return: generator of tuples (number, raw message as bytes) in file name order
+    """
+    number = 0
+    for folder in ('cur', 'new'):
+        folder = os.path.join(path, folder)
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            if name.startswith('.'):
+                continue
+            with open(os.path.join(folder, name), 'rb') as f:
+                number += 1
+                yield number, f.read()
+
+
+def smsxml_records(path, senders=()):
+    """
+    Read SMS from XML backup (<smses><sms address=... date=... body=... /></smses>), the file is
+    memory-mapped and parsed incrementally
+    :param path: XML file name
+    :param senders: SMS address must be one of these strings, all SMS are read if it's empty
+    :return: generator of dicts {'time', 'body', 'sender'}, time is local time of SMS, sender is SMS address
+    """
+    mm = map_file(path)
+    if mm is None:
+        return
+
+    from dateutil import tz
+    with mm:
+        local = tz.tzlocal()
+        context = ET.iterparse(mm, events=('start', 'end'))
+        event, root = next(context)
+        for event, element in context:
+            if event == 'end' and element.tag == 'sms':
+                address = element.get('address') or ''
+                if element.get('body') is not None and (not senders or address in senders):
+                    yield {'time': datetime.fromtimestamp(int(element.get('date')) / 1000, local),
+                           'body': element.get('body'), 'sender': address}
+                root.clear() # Parsed elements are not kept
+
+
+SOURCES = {
+    'mbox': mbox_messages,
+    'maildir': maildir_messages,
+    'smsxml': smsxml_records,
+}
+
+
+def read_source(spec, senders=()):
+    """
+    Read messages from local archive
+    :param spec: '<kind>:<path>', kind is one of SOURCES keys
+    :param senders: strings of bank SMS senders, SMS backup XML has SMS of every sender and is filtered by them
+    :return: generator of tuples (number, raw message as bytes) or dicts {'time', 'body', 'sender'}
+    """
+    kind, colon, path = spec.partition(':')
+    if not colon or kind not in SOURCES:
+        raise ValueError("Unknown source " + spec + ", use " + " | ".join(k + ":path" for k in SOURCES))
+    return SOURCES[kind](path, senders) if kind == 'smsxml' else SOURCES[kind](path)
+
+
+if __name__ == "__main__":
+    print("This module is for import only")
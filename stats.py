@@ -0,0 +1,181 @@
+#!/usr/local/bin/python3
+
+import json, threading, time, tracemalloc
+
+
+class Stage:
+    """
+    Counters of one processing stage
+    """
+    __slots__ = ('name', 'calls', 'items', 'bytes', 'seconds')
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.items = 0
+        self.bytes = 0
+        self.seconds = 0.0 # Own time: nested stages of the same thread are not included, threads are summed
+
+
+class Timer:
+    """
+    Context manager adding own time of the block to the stage, items and bytes can be set inside the block
+    """
+    __slots__ = ('stats', 'name', 'items', 'bytes', 'start', 'outer')
+
+    def __init__(self, stats, name, items=0, nbytes=0):
+        self.stats = stats
+        self.name = name
+        self.items = items
+        self.bytes = nbytes
+
+    def __enter__(self):
+        if self.stats.enabled:
+            local = self.stats.local
+            self.outer = getattr(local, 'nested', 0.0)
+            local.nested = 0.0
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.stats.enabled:
+            elapsed = time.perf_counter() - self.start
+            local = self.stats.local
+            self.stats.add(self.name, elapsed - local.nested, self.items, self.bytes)
+            local.nested = self.outer + elapsed
+        return False
+
+
+class Stats:
+    """
+    Wall time and item counts of processing stages. Does nothing until enabled,
+    so instrumented code costs only a flag check per batch
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {} # Stage objects by name in order of first use
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def add(self, name, seconds=0.0, items=0, nbytes=0, calls=1):
+        """
+        Add counters to the stage
+        :param name: stage name
+        :param seconds: time spent
+        :param items: number of processed items (messages, records)
+        :param nbytes: number of processed bytes
+        :param calls: number of calls
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = Stage(name)
+            stage.calls += calls
+            stage.items += items
+            stage.bytes += nbytes
+            stage.seconds += seconds
+
+    def timer(self, name, items=0, nbytes=0):
+        """
+        :return: Timer context manager for the stage
+        """
+        return Timer(self, name, items, nbytes)
+
+    def timed(self, name, func):
+        """
+        Count every call of function as one item of the stage
+        :param name: stage name
+        :param func: function to wrap
+        :return: wrapped function, func itself if stats are disabled
+        """
+        if not self.enabled:
+            return func
+
+        def wrapper(*args, **kwargs):
+            with Timer(self, name, 1):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def take(self):
+        """
+        Read and reset counters, used to pass counters from worker processes
+        :return: list of tuples (name, calls, items, bytes, seconds)
+        """
+        with self.lock:
+            counters = [(s.name, s.calls, s.items, s.bytes, s.seconds) for s in self.stages.values()]
+            self.stages = {}
+        return counters
+
+    def merge(self, counters):
+        """
+        Add counters taken with take
+        :param counters: list of tuples (name, calls, items, bytes, seconds)
+        """
+        for name, calls, items, nbytes, seconds in counters:
+            self.add(name, seconds, items, nbytes, calls)
+
+    def report(self, tables=()):
+        """
+        :param tables: RuleTable objects which rule counters are reported
+        :return: dict with 'stages', 'rules' and 'memory' (None unless tracemalloc is tracing) keys
+        """
+        stages = [{'stage': s.name, 'calls': s.calls, 'items': s.items, 'bytes': s.bytes,
+                   'seconds': round(s.seconds, 6)} for s in self.stages.values()]
+        rules = []
+        for table in tables:
+            rules.extend(table.stats())
+            rules.append({'bank': table.bank, 'rule': None, 'hits': 0, 'misses': table.unknown})
+
+        memory = None
+        if tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            memory = {'current': current, 'peak': peak,
+                      'top': [{'line': str(s.traceback), 'size': s.size, 'count': s.count} for s in top]}
+        return {'stages': stages, 'rules': rules, 'memory': memory}
+
+    def table(self, tables=()):
+        """
+        :param tables: RuleTable objects which rule counters are reported
+        :return: report as printable summary table
+        """
+        report = self.report(tables)
+        lines = ["%-16s %8s %10s %10s %10s %10s" % ("Stage", "Calls", "Items", "MB", "Seconds", "Items/s")]
+        for s in report['stages']:
+            rate = "%10.0f" % (s['items'] / s['seconds']) if s['seconds'] > 0 and s['items'] else "%10s" % "-"
+            lines.append("%-16s %8d %10d %10.1f %10.3f %s" % (s['stage'], s['calls'], s['items'],
+                                                               s['bytes'] / 2 ** 20, s['seconds'], rate))
+        if report['rules']:
+            lines.append("")
+            lines.append("%-34s %10s %10s" % ("Rule", "Hits", "Misses"))
+            for r in report['rules']:
+                lines.append("%-34s %10d %10d" % (r['bank'] + "." + (r['rule'] or "(unknown)"), r['hits'],
+                                                  r['misses']))
+        if report['memory']:
+            lines.append("")
+            lines.append("Memory: peak %.1f MB, current %.1f MB" % (report['memory']['peak'] / 2 ** 20,
+                                                                   report['memory']['current'] / 2 ** 20))
+            for m in report['memory']['top']:
+                lines.append("%10.1f KB %8d  %s" % (m['size'] / 1024, m['count'], m['line']))
+        return "\n".join(lines)
+
+    def dump(self, fmt='table', tables=()):
+        """
+        Print report
+        :param fmt: 'table' for summary table, 'json' for single JSON line
+        :param tables: RuleTable objects which rule counters are reported
+        """
+        if fmt == 'json':
+            print(json.dumps(self.report(tables)))
+        else:
+            print(self.table(tables))
+
+
+STATS = Stats() # Counters of this process
+
+
+if __name__ == "__main__":
+    print("This module is for import only")
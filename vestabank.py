@@ -1,62 +1,150 @@
 #!/usr/local/bin/python3
 
-import re, pprint
+import re
 from decimal import Decimal
-from dateutil.parser import parse as date_parse
+from dates import parse_sms_time
+from rules import RuleTable, StopWords, Groups, DIGITS, line_end, keywords, first_number
+from records import Operation
 
 
-def stop_words(message):
-    for word in ('карта', 'karta'):
-        if word in message['body'].lower():
-            for word in ('otrazhena v vypiske', 'vhod v internet-bank', 'вход в vestabank', \
-                         'вход в мобильное приложение', 'ispolnen platezh', 'пароль',):
-                if word in message['body'].lower():
-                    return False
-            return True
+SEARCH = "FROM VestaBank" # Default IMAP search string
+SENDERS = ("VestaBank",) # Strings of From header of bank SMS
+
+stop_words = StopWords(include=('карта', 'karta'),
+                       exclude=('otrazhena v vypiske', 'vhod v internet-bank', 'вход в vestabank',
+                                'вход в мобильное приложение', 'ispolnen platezh', 'пароль'))
+SERVER_EXCLUDE = ('пароль', 'vhod v internet-bank', 'вход в vestabank', 'вход в мобильное приложение')
+
+
+rules = RuleTable('vesta')
+
+# Keywords are written in Latin or Cyrillic letters
+CARD = re.compile(r'[0-9]+: ')
+SEPARATOR = re.compile(r'[.,] ')
+COMISSION = ('комиссия D', 'komissiya D')
+DOSTUPNO = ('Доступно ', 'Dostupno ')
+# Usual form of purchase: comission is optional, place runs up to '. Dostupno' which is the only one in the message
+PURCHASE = re.compile(r'(?:Karta|Карта) ([0-9]+): ([^,\n]+), ([^ \n]+(?: [^ 0-9.\n][^ \n]*)*) ([0-9.]+) ([^.,\n]+)[.,] '
+                      r'(?:(?:комиссия|komissiya) D([0-9.]+) ([^.\n]+)\. |(?!комиссия D|komissiya D))'
+                      r'(?:((?:(?!Доступно|Dostupno)[^\n])+)\. )? *(?:Доступно|Dostupno) ([0-9.]+) '
+                      r'((?:(?!Доступно|Dostupno)[^.\n])+)(?![^\n]*?\. +(?:Доступно|Dostupno))\.')
+
+
+def balances(body, pos, end):
+    """
+    ' *Dostupno <balance> <currency>.' ends the message, the text before it may end with '. ' of place
+    :param body: SMS text
+    :param pos: position to search from
+    :param end: end of the first line
+    :return: list of tuples (position of 'Dostupno', end of text before it, dot ending place or -1,
+            balance match, dot ending currency)
+    """
+    found = []
+    for word in keywords(body, DOSTUPNO, pos, end):
+        bal = DIGITS.match(body, word + len(DOSTUPNO[0]))
+        dot = body.find('.', bal.end() + 2, end) if bal and body.startswith(' ', bal.end()) else -1
+        if dot < 0:
+            continue
+        text = word
+        while body[text - 1] == ' ':
+            text -= 1
+        found.append((word, text, text - 1 if body[text - 1] == '.' and text < word else -1, bal, dot))
+    return found
+
+
+def place_balance(found, pos):
+    """
+    Optional place and balance after separator or comission, (?:(.+?)\. )? *(?:Доступно|Dostupno) of regex
+    :param found: list made by balances
+    :param pos: place start
+    :return: tuple (place end or -1 if there is no place, balance tuple of found), None if balance doesn't follow
+    """
+    for balance in found:
+        if balance[2] > pos: # Lazy place ends at the first '. ' which spaces and 'Dostupno' follow
+            return balance[2], balance
+    for balance in found:
+        if balance[1] <= pos <= balance[0]:
+            return -1, balance
+    return None
+
+
+def parse_purchase(body):
+    """
+    Token parser of purchase
+    :param body: SMS text
+    :return: Groups object, None if message doesn't match
+    """
+    values = PURCHASE.match(body)
+    if values:
+        return values
+    card = CARD.match(body, 6) if body.startswith(('Karta ', 'Карта ')) else None
+    end = line_end(body)
+    comma = body.find(', ', card.end() + 1, end) if card else -1
+    space, total = first_number(body, comma + 3, end, DIGITS) if comma >= 0 else (-1, -1)
+    found = balances(body, total + 4, end) if space >= 0 else ()
+    stops = [balance[2] for balance in found if balance[2] >= 0]
+    next_dot = -1 # Comission currency ends at the first '. ' after it, remembered for the next separators
+    for separator in SEPARATOR.finditer(body, total + 2, found[-1][0] if found else 0):
+        after = separator.end()
+        comission = currency = rest = None
+        if body.startswith(COMISSION, after) and stops:
+            value = DIGITS.match(body, body.find('D', after) + 1)
+            if value and body.startswith(' ', value.end()):
+                if next_dot < value.end() + 2:
+                    next_dot = body.find('. ', value.end() + 2, max(stops) + 2)
+                if next_dot < max(stops) - 2: # Place after comission is at least one character
+                    dot = next_dot
+                else:
+                    dot = min([s for s in stops if s >= value.end() + 2] or [-1])
+                rest = place_balance(found, dot + 2) if dot >= 0 else None
+                if rest:
+                    comission, currency, start = value.group(), body[value.end() + 1:dot], dot + 2
+        if not rest:
+            rest, start = place_balance(found, after), after
+        if rest:
+            place, (word, text, stop, bal, dot) = rest
+            return Groups((body[6:card.end() - 2], body[card.end():comma], body[comma + 2:space],
+                           body[space + 1:total], body[total + 1:separator.start()], comission, currency,
+                           body[start:place] if place >= 0 else None, bal.group(), body[bal.end() + 1:dot]))
+    return None
+
+
+@rules.rule(r'^(?:Karta|Карта) ([0-9]+?): (.+?), (.+?) ([0-9.]+) (.+?)[.,] (?:(?:комиссия|komissiya) D([0-9.]+) (.+?)\. )?(?:(.+?)\. )? *(?:Доступно|Dostupno) ([0-9.]+) (.+?)\.',
+            prefix=('Karta ', 'Карта '), markers=(DOSTUPNO,), parse=parse_purchase)
+def purchase(values, transaction): # Purchases, ATM operations and another incomes&expences
+    return Operation(
+        time=transaction['time'],
+        card=values.group(1),
+        time1=parse_sms_time(values.group(2)),
+        oper=values.group(3),
+        sum=Decimal(values.group(4)) if values.group(4) else None,
+        currency=values.group(5),
+        comission=Decimal(values.group(6)) if values.group(6) else None,
+        commcurr=values.group(7),
+        place=values.group(8),
+        bal=Decimal(values.group(9)) if values.group(9) else None
+    )
+
+
+def parse_sms_list(trans_list, warn=False):
+    """
+    Parse every SMS on its own
+    :param warn: print warnings
+    :param trans_list: list of transactions as dicts with 'time' and 'body' keys
+    :return: tuple of (operations, transfers), see process_sms_list
+    """
+    return rules.parse_sms_list(trans_list, warn)
 
-    return False
 
 def process_sms_list(trans_list, warn=False):
     """
     Make list of operations from list of SMS
     :param warn: print warnings
     :param trans_list: list of transactions as dicts with 'time' and 'body' keys
-    :return: tuple of (operations, transfers), operations as list of dicts with 'card', 'time', time1', 'time2', 'operation', 'currency',
-            'sum', 'balance', 'person', 'place', 'name', 'sum1', 'comment' keys
-            transfers as list of dicts with 'name', 'sum', 'comment', 'time' keys
-    """
-
-    oper = []  # Card operations
-    trf = []  # Money transfers
-
-    purchase_re = re.compile(r'^(?:Karta|Карта) ([0-9]+?): (.+?), (.+?) ([0-9.]+) (.+?)[.,] (?:(?:комиссия|komissiya) D([0-9.]+) (.+?)\. )?(?:(.+?)\. )? *(?:Доступно|Dostupno) ([0-9.]+) (.+?)\.')
-
-    for transaction in trans_list:
-        try:
-            values = purchase_re.match(transaction['body'])
-            if values: # Purchases, ATM operations and another incomes&expences
-                d = {
-                    'time': transaction['time'],
-                    'card': values.group(1),
-                    'time1': date_parse(values.group(2), dayfirst=True),
-                    'oper': values.group(3),
-                    'sum': Decimal(values.group(4)) if values.group(4) else None,
-                    'currency': values.group(5),
-                    'comission': Decimal(values.group(6)) if values.group(6) else None,
-                    'commcurr': values.group(7),
-                    'place': values.group(8),
-                    'bal': Decimal(values.group(9)) if values.group(9) else None
-                }
-                oper.append(d)
-                continue
-            if warn:
-                print("WARNING: unknown transaction")
-                pprint.pprint(transaction)
-        except:
-            print("ERROR: unable to process")
-            pprint.pprint(transaction)
-
-    return oper, trf
+    :return: tuple of (operations, transfers), operations as list of records.Operation,
+            transfers as list of records.Transfer
+    """
+    return parse_sms_list(trans_list, warn)
 
 if __name__ == "__main__":
     print("This module is for import only")
@@ -1,99 +1,265 @@
 #!/usr/local/bin/python3
 
-import re, pprint
+import re
 from decimal import Decimal
-from dateutil.parser import parse as date_parse
+from dates import parse_sms_time
+from rules import RuleTable, StopWords, Groups, DIGITS, line_end, keywords, first_number
+from records import Operation
 
 
-def stop_words(message):
-    for word in ('карта', 'karta'):
-        if word in message['body'].lower():
-            for word in ('nikomu ne', 'vhod v', \
-                         'вход в', 'пароль',):
-                if word in message['body'].lower():
-                    return False
-            return True
+SEARCH = "FROM VTB" # Default IMAP search string
+SENDERS = ("VTB",) # Strings of From header of bank SMS
 
-    return False
+stop_words = StopWords(include=('карта', 'karta'),
+                       exclude=('nikomu ne', 'vhod v', 'вход в', 'пароль'))
+SERVER_EXCLUDE = ('пароль', 'nikomu ne', 'vhod v', 'вход в')
 
-def process_sms_list(trans_list, warn=False):
+
+rules = RuleTable('vtb')
+
+# Keywords are written in Latin or Cyrillic letters
+CARD = re.compile(r'[0-9]+: ')
+TIME = re.compile(r' [0-9]+:[0-9]+')
+KARTA = (' Karta*', ' Карта*')
+BALANS = (' Balans ', ' Баланс ')
+# Usual forms of purchase, refund and short purchase: operation name ends before the first word that starts
+# with a digit, place of purchase runs up to the only ',dostupno' or ';dostupno'
+OPERATION = r'([^ \n]+(?: [^ 0-9.\n][^ \n]*)*) ([0-9.]+)'
+PURCHASE = re.compile(r'Karta \*([0-9]+): ' + OPERATION + r' ([^;\n]+);([^;\n]+);((?:(?![,;] ?dostupno )[^\n])+)'
+                      r'[,;] ?dostupno ([0-9.]+) ([^\W\d_]+)(?:\.\n?)?\Z')
+REFUND = re.compile(r'Karta \*([0-9]+): ' + OPERATION + r' ([^;\n]+); ?dostupno ([0-9.]+) ([^.\n]+)\.[^\n]*$')
+PURCHASE2 = re.compile(OPERATION + r'([^ 0-9.\n][^ \n]*) (?:Karta|Карта)\*([^ \n]+) '
+                       r'((?:(?! (?:Balans|Баланс) )[^\n])+) '
+                       r'(?:Balans|Баланс) ([0-9.]+)([^ 0-9.\n][^ \n]*) ([0-9]+:[0-9]+)')
+
+
+def first_of(text, words, pos, end):
     """
-    Make list of operations from list of SMS
-    :param warn: print warnings
-    :param trans_list: list of transactions as dicts with 'time' and 'body' keys
-    :return: tuple of (operations, transfers), operations as list of dicts with 'card', 'time', time1', 'time2', 'operation', 'currency',
-            'sum', 'balance', 'person', 'place', 'name', 'sum1', 'comment' keys
-            transfers as list of dicts with 'name', 'sum', 'comment', 'time' keys
+    :param text: SMS text
+    :param words: tuple of strings of the same length
+    :param pos: position to search from
+    :param end: position the word must end before
+    :return: position of the first word found, -1 if there is none
     """
+    found = [at for at in (text.find(w, pos, end) for w in words) if at >= 0]
+    return min(found) if found else -1
 
-    oper = []  # Card operations
-    trf = []  # Money transfers
 
-# Karta *8741: Oplata 250.00 RUB;IP SOROKIN E.A. SMT;21.10.2018 17:05,dostupno 283.16 RUB
+def card_sum(body):
+    """
+    'Karta *<card>: <operation> <sum> ' start of message
+    :param body: SMS text
+    :return: tuple (card, operation, sum, sum end), None if message doesn't start so
+    """
+    card = CARD.match(body, 7) if body.startswith('Karta *') else None
+    space, total = first_number(body, card.end() + 1, line_end(body), DIGITS) if card else (-1, -1)
+    if space < 0:
+        return None
+    return body[7:card.end() - 2], body[card.end():space], body[space + 1:total], total
 
-    purchase_re = re.compile(r'^Karta \*([0-9]+?): (.+?) ([0-9.]+) (.+?);(.+?);(.+)[,;] ?dostupno ([0-9.]+) ([^.]+)(?:\(.+\))?\.?$')
-    refund_re = re.compile(r'^Karta \*([0-9]+?): (.+?) ([0-9.]+) (.+?); ?dostupno ([0-9.]+) ([^.]+).+$')
-
-    purchase2_re = re.compile(r'^(.+?) ([0-9.]+)(.+?) (?:Karta|Карта)\*(.+?) (.+?) (?:Balans|Баланс) ([0-9.]+)(.+?) ([0-9]+:[0-9]+)')
-
-    for transaction in trans_list:
-        try:
-            values = purchase_re.match(transaction['body'])
-            if values: # Purchases, ATM operations and another incomes&expences
-                d = {
-                    'time': transaction['time'],
-                    'card': values.group(1),
-                    'time1': date_parse(values.group(6), dayfirst=True),
-                    'oper': values.group(2),
-                    'sum': Decimal(values.group(3)) if values.group(3) else None,
-                    'currency': values.group(4),
-                    'comission': None,
-                    'commcurr': None,
-                    'place': values.group(5).strip(),
-                    'bal': Decimal(values.group(7)) if values.group(7) else None
-                }
-                oper.append(d)
-                continue
-            values = refund_re.match(transaction['body'])
-            if values: # Refunds and another deposits
-                d = {
-                    'time': transaction['time'],
-                    'card': values.group(1),
-                    'time1': None,
-                    'oper': values.group(2),
-                    'sum': Decimal(values.group(3)) if values.group(3) else None,
-                    'currency': values.group(4),
-                    'comission': None,
-                    'commcurr': None,
-                    'place': None,
-                    'bal': Decimal(values.group(5)) if values.group(5) else None
-                }
-                oper.append(d)
-                continue
-            values = purchase2_re.match(transaction['body'])
-            if values: # Refunds and another deposits
-                d = {
-                    'time': transaction['time'],
-                    'card': values.group(4),
-                    'time1': date_parse(values.group(8), default=transaction['time'], dayfirst=True),
-                    'oper': values.group(1),
-                    'sum': Decimal(values.group(2)) if values.group(2) else None,
-                    'currency': values.group(3),
-                    'comission': None,
-                    'commcurr': None,
-                    'place': values.group(5),
-                    'bal': Decimal(values.group(6)) if values.group(6) else None
-                }
-                oper.append(d)
+
+def currency_tail(body, pos):
+    """
+    Balance currency ending the message, ([^.]+)(?:\(.+\))?\.?$ of regex
+    :param body: SMS text
+    :param pos: currency start
+    :return: currency end, -1 if message doesn't end so
+    """
+    size = len(body)
+    ends = (size - 1, size) if body.endswith('\n') else (size,) # Positions where $ matches
+    dot = body.find('.', pos)
+    if dot < 0:
+        return size if size > pos else -1
+    if dot > pos and (dot + 1 in ends):
+        return dot
+    found = -1 # Greedy ([^.]+) ends at the last '(' which (.+\)\.?$ can follow
+    for close in range(size - 1, max(pos, size - 4), -1):
+        if body[close] == ')' and (close + 1 in ends or body.startswith('.', close + 1) and close + 2 in ends):
+            bracket = body.rfind('(', pos + 1, min(dot, close - 1))
+            if bracket > found and '\n' not in body[bracket:close]:
+                found = bracket
+    return found
+
+
+def parse_purchase(body):
+    """
+    Token parser of purchase
+    :param body: SMS text
+    :return: Groups object, None if message doesn't match
+    """
+    values = PURCHASE.match(body)
+    if values:
+        return values
+    start = card_sum(body)
+    if not start:
+        return None
+    card, oper, total, pos = start
+    end = line_end(body)
+    currency = body.find(';', pos + 2, end)
+    place = body.find(';', currency + 2, end) if currency >= 0 else -1
+    for word in keywords(body, 'dostupno ', place + 3, end, reverse=True) if place >= 0 else ():
+        time = word - 2 if body.startswith((', ', '; '), word - 2) else word - 1
+        bal = DIGITS.match(body, word + len('dostupno '))
+        if time < place + 2 or body[time] not in ',;' or not bal or not body.startswith(' ', bal.end()):
+            continue
+        tail = currency_tail(body, bal.end() + 1)
+        if tail >= 0:
+            return Groups((card, oper, total, body[pos + 1:currency], body[currency + 1:place], body[place + 1:time],
+                           bal.group(), body[bal.end() + 1:tail]))
+    return None
+
+
+def parse_refund(body):
+    """
+    Token parser of refund
+    :param body: SMS text
+    :return: Groups object, None if message doesn't match
+    """
+    values = REFUND.match(body)
+    if values:
+        return values
+    start = card_sum(body)
+    if not start:
+        return None
+    card, oper, total, pos = start
+    size = len(body)
+    text_end = size - 1 if body.endswith('\n') else size # Last position .+$ can end at
+    last_line = body.rfind('\n', 0, text_end) + 1
+    for word in keywords(body, 'dostupno ', pos + 3, line_end(body)):
+        currency = word - 2 if body.startswith('; ', word - 2) else word - 1
+        bal = DIGITS.match(body, word + len('dostupno '))
+        if currency < pos + 2 or body[currency] != ';' or not bal or not body.startswith(' ', bal.end()):
+            continue
+        dot = body.find('.', bal.end() + 1)
+        tail = min(text_end - 1, size if dot < 0 else dot) # Greedy ([^.]+) leaves the last line rest to .+$
+        if tail > bal.end() + 1 and tail >= last_line:
+            return Groups((card, oper, total, body[pos + 1:currency], bal.group(), body[bal.end() + 1:tail]))
+    return None
+
+
+def card_balance(body, karta, end):
+    """
+    '<card> <place> Balans <balance><currency> <time>' after 'Karta*' of purchase2
+    :param body: SMS text
+    :param karta: position of ' Karta*'
+    :param end: end of the first line
+    :return: list of card, place, balance, currency and time, None if the text doesn't match
+    """
+    card = body.find(' ', karta + len(KARTA[0]) + 1, end)
+    times = [t.start() for t in TIME.finditer(body, card + 1, end)] if card >= 0 else ()
+    for balans in keywords(body, BALANS, card + 2, end) if times else ():
+        bal = DIGITS.match(body, balans + len(BALANS[0]), end)
+        if not bal:
+            continue
+        bal_end = bal.end()
+        if times[-1] <= bal_end: # Lazy currency needs a character, greedy balance gives it back
+            if times[-1] < bal_end or bal_end - bal.start() < 2:
                 continue
-            if warn:
-                print("WARNING: unknown transaction")
-                pprint.pprint(transaction)
-        except:
-            print("ERROR: unable to process")
-            pprint.pprint(transaction)
-
-    return oper, trf
+            bal_end -= 1
+        time = TIME.search(body, bal_end + 1, end)
+        return [body[karta + len(KARTA[0]):card], body[card + 1:balans], body[bal.start():bal_end],
+                body[bal_end:time.start()], time.group()[1:]]
+    return None
+
+
+def parse_purchase2(body):
+    """
+    Token parser of purchase2
+    :param body: SMS text
+    :return: Groups object, None if message doesn't match
+    """
+    values = PURCHASE2.match(body)
+    if values:
+        return values
+    end = line_end(body)
+    space = body.find(' ', 1, end)
+    while space >= 0 and not DIGITS.match(body, space + 1, end):
+        space = body.find(' ', space + 1, end)
+    total = DIGITS.match(body, space + 1, end) if space >= 0 else None
+    if not total:
+        return None
+    karta = first_of(body, KARTA, total.end() + 1, end)
+    tries = [(total.end(), karta)] if karta >= 0 else []
+    if total.end() - total.start() > 1 and body.startswith(KARTA, total.end()): # Sum gives its last character
+        tries.append((total.end() - 1, total.end()))
+    for total_end, karta in tries:
+        values = card_balance(body, karta, end)
+        if values:
+            return Groups((body[:space], body[space + 1:total_end], body[total_end:karta], *values))
+    return None
+
+
+# Karta *8741: Oplata 250.00 RUB;IP SOROKIN E.A. SMT;21.10.2018 17:05,dostupno 283.16 RUB
+@rules.rule(r'^Karta \*([0-9]+?): (.+?) ([0-9.]+) (.+?);(.+?);(.+)[,;] ?dostupno ([0-9.]+) ([^.]+)(?:\(.+\))?\.?$',
+            prefix='Karta *', markers=('dostupno ',), parse=parse_purchase)
+def purchase(values, transaction): # Purchases, ATM operations and another incomes&expences
+    return Operation(
+        time=transaction['time'],
+        card=values.group(1),
+        time1=parse_sms_time(values.group(6)),
+        oper=values.group(2),
+        sum=Decimal(values.group(3)) if values.group(3) else None,
+        currency=values.group(4),
+        comission=None,
+        commcurr=None,
+        place=values.group(5).strip(),
+        bal=Decimal(values.group(7)) if values.group(7) else None
+    )
+
+
+@rules.rule(r'^Karta \*([0-9]+?): (.+?) ([0-9.]+) (.+?); ?dostupno ([0-9.]+) ([^.]+).+$',
+            prefix='Karta *', markers=('dostupno ',), parse=parse_refund)
+def refund(values, transaction): # Refunds and another deposits
+    return Operation(
+        time=transaction['time'],
+        card=values.group(1),
+        time1=None,
+        oper=values.group(2),
+        sum=Decimal(values.group(3)) if values.group(3) else None,
+        currency=values.group(4),
+        comission=None,
+        commcurr=None,
+        place=None,
+        bal=Decimal(values.group(5)) if values.group(5) else None
+    )
+
+
+@rules.rule(r'^(.+?) ([0-9.]+)(.+?) (?:Karta|Карта)\*(.+?) (.+?) (?:Balans|Баланс) ([0-9.]+)(.+?) ([0-9]+:[0-9]+)',
+            markers=(KARTA, BALANS), parse=parse_purchase2)
+def purchase2(values, transaction): # Purchases, new style
+    return Operation(
+        time=transaction['time'],
+        card=values.group(4),
+        time1=parse_sms_time(values.group(8), default=transaction['time']),
+        oper=values.group(1),
+        sum=Decimal(values.group(2)) if values.group(2) else None,
+        currency=values.group(3),
+        comission=None,
+        commcurr=None,
+        place=values.group(5),
+        bal=Decimal(values.group(6)) if values.group(6) else None
+    )
+
+
+def parse_sms_list(trans_list, warn=False):
+    """
+    Parse every SMS on its own
+    :param warn: print warnings
+    :param trans_list: list of transactions as dicts with 'time' and 'body' keys
+    :return: tuple of (operations, transfers), see process_sms_list
+    """
+    return rules.parse_sms_list(trans_list, warn)
+
+
+def process_sms_list(trans_list, warn=False):
+    """
+    Make list of operations from list of SMS
+    :param warn: print warnings
+    :param trans_list: list of transactions as dicts with 'time' and 'body' keys
+    :return: tuple of (operations, transfers), operations as list of records.Operation,
+            transfers as list of records.Transfer
+    """
+    return parse_sms_list(trans_list, warn)
 
 if __name__ == "__main__":
     print("This module is for import only")
@@ -0,0 +1,439 @@
+#!/usr/local/bin/python3
+
+import os, io, re, csv, json, sqlite3, itertools
+from datetime import datetime
+from decimal import Decimal
+
+OPERATION_COLUMNS = ("Card", "Time", "Time in SMS", "Operation", "Sum", "Currency",
+                     "Comission", "Comm. currency", "Balance", "Place",
+                     "Name", "Comment", "Time of transfer")
+TRANSFER_COLUMNS = ('Time', 'Name', 'Sum', 'Comment')
+KEYS = { # Columns of the stable key of a row, columns that may change later (transfer matched in next runs)
+    OPERATION_COLUMNS: ((0, 1, 4, 8), (10, 11, 12)), # Card, Time, Sum, Balance; transfer
+    TRANSFER_COLUMNS: ((0, 1, 2, 3), ()),
+}
+
+
+def operation_rows(oper):
+    """
+    Rows of Operations table
+    :param oper: list of records.Operation
+    :return: generator of tuples in OPERATION_COLUMNS order
+    """
+    for o in oper:
+        if o.transfer is None:
+            yield (o.card, o.time, o.time1, o.oper, o.sum, o.currency, o.comission, o.commcurr, o.bal, o.place,
+                   "", "", "")
+        else:
+            yield (o.card, o.time, o.time1, o.oper, o.sum, o.currency, o.comission, o.commcurr, o.bal, o.place,
+                   o.transfer.name, o.transfer.comment, o.transfer.time)
+
+
+def transfer_rows(trf):
+    """
+    Rows of Transfers table
+    :param trf: list of records.Transfer
+    :return: generator of tuples in TRANSFER_COLUMNS order
+    """
+    for t in trf:
+        yield t.time, t.name, t.sum, t.comment
+
+
+def excel_value(value):
+    """
+    Excel has no timezones, local time of SMS is written
+    """
+    return value.replace(tzinfo=None) if isinstance(value, datetime) else value
+
+
+def text_value(value):
+    """
+    Dates and decimals as strings for text formats and SQLite
+    """
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    return value
+
+
+def grouped(records, field):
+    """
+    Split records by field value
+    :param records: list of records
+    :param field: record field name
+    :return: list of tuples (value as string, list of records) in order of first appearance
+    """
+    groups = {}
+    for r in records:
+        value = getattr(r, field)
+        groups.setdefault("" if value is None else str(value), []).append(r)
+    return list(groups.items())
+
+
+def output_tables(oper, trf, group=None, extra=()):
+    """
+    Tables to write
+    :param oper: list of operations
+    :param trf: list of transfers
+    :param group: None for single Operations table, 'bank' or 'card' for Operations table per bank or card
+            (transfers are split by bank too)
+    :param extra: more tables (title, columns, rows) written after them, e.g. analytics.summary_tables
+    :return: list of tuples (title, columns, rows), Operations first
+    """
+    if group is None:
+        return [("Operations", OPERATION_COLUMNS, operation_rows(oper)),
+                ("Transfers", TRANSFER_COLUMNS, transfer_rows(trf))] + list(extra)
+
+    tables = [(("Operations " + key).strip(), OPERATION_COLUMNS, operation_rows(records))
+              for key, records in grouped(oper, group)] or [("Operations", OPERATION_COLUMNS, iter(()))]
+    if group == 'bank':
+        tables.extend((("Transfers " + key).strip(), TRANSFER_COLUMNS, transfer_rows(records))
+                      for key, records in grouped(trf, group))
+    elif trf:
+        tables.append(("Transfers", TRANSFER_COLUMNS, transfer_rows(trf)))
+    return tables + list(extra)
+
+
+def table_name(title):
+    """
+    :return: table title as lowercase identifier for file and SQL table names ('Operations *1234' -> 'operations_1234')
+    """
+    return re.sub(r'\W+', '_', title.lower()).strip('_')
+
+
+def sheet_title(title, used):
+    """
+    Excel sheet title: no []:*?/\\ characters, 31 characters at most, unique
+    :param title: table title
+    :param used: set of titles already taken, the new one is added
+    """
+    title = re.sub(r'[\[\]:*?/\\]', '', title)[:31].strip() or "Sheet"
+    base, n = title, 1
+    while title.lower() in used:
+        n += 1
+        title = base[:31 - len(str(n)) - 3] + " (" + str(n) + ")"
+    used.add(title.lower())
+    return title
+
+
+def save_xlsx(oper, trf, path, group=None, extra=()):
+    """
+    Save operations to xlsx, a sheet per table, rows are streamed with write-only workbook
+    """
+    from openpyxl import Workbook # Heavy import, only when xlsx is written
+    wb = Workbook(write_only=True)
+
+    used = set()
+    for n, (title, columns, rows) in enumerate(output_tables(oper, trf, group, extra)):
+        row = next(rows, None)
+        if row is None and n: # Empty transfers table is not written
+            continue
+        ws = wb.create_sheet(sheet_title(title, used))
+        ws.append(columns)
+        for row in itertools.chain((row,) if row is not None else (), rows):
+            ws.append([excel_value(v) for v in row])
+
+    wb.save(path)
+
+
+def write_csv(path, columns, rows):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([text_value(v) for v in row])
+
+
+def save_csv(oper, trf, path, group=None, extra=()):
+    """
+    Save operations to CSV, the first table goes to path, the rest (transfers) to <name>_<table>.csv next to it
+    """
+    for n, (title, columns, rows) in enumerate(output_tables(oper, trf, group, extra)):
+        row = next(rows, None)
+        if row is None and n: # Empty transfers table is not written
+            continue
+        write_csv(path if not n else os.path.splitext(path)[0] + "_" + table_name(title) + ".csv", columns,
+                  itertools.chain((row,) if row is not None else (), rows))
+
+
+def save_jsonl(oper, trf, path, group=None, extra=()):
+    """
+    Save operations and transfers to JSON Lines, one object per row with 'Table' key
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        for table, columns, rows in output_tables(oper, trf, group, extra):
+            for row in rows:
+                record = {'Table': table}
+                record.update(zip(columns, map(text_value, row)))
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def save_sqlite(oper, trf, path, group=None, extra=()):
+    """
+    Save operations and transfers to SQLite tables ('operations' and 'transfers' if not grouped),
+    existing tables are replaced
+    """
+    db = sqlite3.connect(path)
+    db.execute('DROP TABLE IF EXISTS ' + RowIndex.ROWS) # Tables are new, rows appended before are gone
+    for title, columns, rows in output_tables(oper, trf, group, extra):
+        table = table_name(title)
+        names = ", ".join('"' + c + '"' for c in columns)
+        db.execute('DROP TABLE IF EXISTS ' + table)
+        db.execute('CREATE TABLE ' + table + ' (' + names + ')')
+        db.executemany('INSERT INTO ' + table + ' VALUES (' + ", ".join("?" * len(columns)) + ')',
+                       ([text_value(v) for v in row] for row in rows))
+    db.commit()
+    db.close()
+
+
+class RowIndex:
+    """
+    Keys of rows already written to output by append mode: where every row is (file offset or rowid)
+    and the state of its changeable columns, kept in SQLite (output database itself or companion file)
+    """
+    ROWS = 'written_rows'
+    FILES = 'written_files'
+
+    def __init__(self, db):
+        """
+        :param db: sqlite3 connection
+        """
+        self.db = db
+        db.execute('CREATE TABLE IF NOT EXISTS ' + self.ROWS +
+                   ' (tbl TEXT, key TEXT, pos INTEGER, state TEXT, PRIMARY KEY (tbl, key))')
+        db.execute('CREATE TABLE IF NOT EXISTS ' + self.FILES + ' (tbl TEXT PRIMARY KEY, size INTEGER)')
+
+    def rows(self, table):
+        """
+        :return: dict key -> (position, state) of rows written to the table (file)
+        """
+        return {key: (pos, state) for key, pos, state in
+                self.db.execute('SELECT key, pos, state FROM ' + self.ROWS + ' WHERE tbl = ?', (table,))}
+
+    def size(self, table):
+        """
+        :return: file size after the last append, None if unknown
+        """
+        row = self.db.execute('SELECT size FROM ' + self.FILES + ' WHERE tbl = ?', (table,)).fetchone()
+        return row[0] if row else None
+
+    def forget(self, table):
+        self.db.execute('DELETE FROM ' + self.ROWS + ' WHERE tbl = ?', (table,))
+        self.db.execute('DELETE FROM ' + self.FILES + ' WHERE tbl = ?', (table,))
+
+    def put(self, table, rows, size=None):
+        """
+        :param table: table (file) name
+        :param rows: iterable of tuples (key, position, state)
+        :param size: file size now
+        """
+        self.db.executemany('INSERT OR REPLACE INTO ' + self.ROWS + ' (tbl, key, pos, state) VALUES (?, ?, ?, ?)',
+                            ((table, key, pos, state) for key, pos, state in rows))
+        if size is not None:
+            self.db.execute('INSERT OR REPLACE INTO ' + self.FILES + ' (tbl, size) VALUES (?, ?)', (table, size))
+
+
+def keyed_rows(columns, rows):
+    """
+    Stable keys of rows: card, time, sum and balance for operations. Equal rows get '#2', '#3'... suffixes
+    :param columns: OPERATION_COLUMNS or TRANSFER_COLUMNS
+    :param rows: iterable of rows
+    :return: generator of tuples (key, state of changeable columns, row)
+    """
+    key_columns, state_columns = KEYS[columns]
+    seen = {}
+    for row in rows:
+        key = "|".join(str(text_value(row[i])) for i in key_columns)
+        n = seen[key] = seen.get(key, 0) + 1
+        if n > 1:
+            key += "#" + str(n)
+        yield key, "|".join(str(text_value(row[i])) for i in state_columns), row
+
+
+def append_lines(path, index, rows, encode, header=b""):
+    """
+    Bring line-per-row file up to date: new rows are appended, changed rows are written again
+    together with the rows after them, rows before the first changed one are not touched.
+    File changed by anything else (size differs from the index) is written anew.
+    Rows are compared with the index by key and state, only new and changed rows are encoded
+    :param path: file name
+    :param index: RowIndex
+    :param rows: iterable of tuples (key, state, row)
+    :param encode: function(row) that returns the line of row as bytes
+    :param header: first line of new file
+    """
+    table = os.path.basename(path)
+    known = index.rows(table) if os.path.exists(path) and os.path.getsize(path) == index.size(table) else {}
+    if not known:
+        index.forget(table)
+    new, changed = [], {}
+    for key, state, row in rows:
+        old = known.get(key)
+        if old is None:
+            new.append((key, state, encode(row)))
+        elif old[1] != state:
+            changed[old[0]] = (key, state, encode(row))
+
+    with open(path, 'r+b' if known else 'w+b') as f:
+        written = []
+        if not known:
+            f.write(header)
+        if changed:
+            cut = min(changed)
+            tail = [(pos, key, state) for key, (pos, state) in known.items() if pos >= cut]
+            tail.sort()
+            f.seek(cut)
+            data = f.read()
+            f.seek(cut)
+            f.truncate()
+            ends = [pos - cut for pos, key, state in tail[1:]] + [len(data)]
+            for (pos, key, state), start, end in zip(tail, [0] + ends, ends):
+                key, state, line = changed.get(pos, (key, state, data[start:end]))
+                written.append((key, f.tell(), state))
+                f.write(line)
+        f.seek(0, os.SEEK_END)
+        for key, state, line in new:
+            written.append((key, f.tell(), state))
+            f.write(line)
+        index.put(table, written, f.tell())
+
+
+def csv_line(row):
+    """
+    :return: row as CSV line in bytes, the same as write_csv writes
+    """
+    buffer = io.StringIO(newline='')
+    csv.writer(buffer).writerow([text_value(v) for v in row])
+    return buffer.getvalue().encode('utf-8')
+
+
+def append_csv(oper, trf, path, group=None, extra=()):
+    """
+    Append mode of save_csv, row index goes to <path>.index. Extra tables are written anew
+    """
+    db = sqlite3.connect(path + ".index")
+    index = RowIndex(db)
+    for n, (title, columns, rows) in enumerate(output_tables(oper, trf, group, extra)):
+        row = next(rows, None)
+        if row is None and n:
+            continue
+        rows = itertools.chain((row,) if row is not None else (), rows)
+        name = path if not n else os.path.splitext(path)[0] + "_" + table_name(title) + ".csv"
+        if columns not in KEYS:
+            write_csv(name, columns, rows)
+            continue
+        append_lines(name, index, keyed_rows(columns, rows), csv_line, csv_line(columns))
+        db.commit()
+    db.close()
+
+
+def append_jsonl(oper, trf, path, group=None, extra=()):
+    """
+    Append mode of save_jsonl, row index goes to <path>.index. Extra tables can't be replaced in the middle
+    of the file, they are not written
+    """
+    def rows():
+        for table, columns, table_rows in output_tables(oper, trf, group):
+            for key, state, row in keyed_rows(columns, table_rows):
+                yield table + "|" + key, state, (table, columns, row)
+
+    def encode(item):
+        table, columns, row = item
+        record = {'Table': table}
+        record.update(zip(columns, map(text_value, row)))
+        return (json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8')
+
+    if extra:
+        print("WARNING: summary tables are not appended to JSON Lines, use csv or sqlite")
+    db = sqlite3.connect(path + ".index")
+    append_lines(path, RowIndex(db), rows(), encode)
+    db.commit()
+    db.close()
+
+
+def append_sqlite(oper, trf, path, group=None, extra=()):
+    """
+    Append mode of save_sqlite: new rows are inserted, rows with transfer matched later are updated,
+    the row index is kept in the database itself. Extra tables are replaced
+    """
+    db = sqlite3.connect(path)
+    index = RowIndex(db)
+    for title, columns, rows in output_tables(oper, trf, group, extra):
+        table = table_name(title)
+        names = ", ".join('"' + c + '"' for c in columns)
+        exists = db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+        known = index.rows(table) if exists and columns in KEYS else {}
+        if not known: # Table of save_sqlite or a new one
+            index.forget(table)
+            db.execute('DROP TABLE IF EXISTS ' + table)
+            db.execute('CREATE TABLE ' + table + ' (' + names + ')')
+            if columns not in KEYS:
+                db.executemany('INSERT INTO ' + table + ' VALUES (' + ", ".join("?" * len(columns)) + ')',
+                               ([text_value(v) for v in row] for row in rows))
+                continue
+
+        insert = 'INSERT INTO ' + table + ' VALUES (' + ", ".join("?" * len(columns)) + ')'
+        update = 'UPDATE ' + table + ' SET ' + ", ".join('"' + c + '" = ?' for c in columns) + ' WHERE rowid = ?'
+        written = []
+        for key, state, row in keyed_rows(columns, rows):
+            old = known.get(key)
+            values = [text_value(v) for v in row]
+            if old is None:
+                written.append((key, db.execute(insert, values).lastrowid, state))
+            elif old[1] != state:
+                db.execute(update, values + [old[0]])
+                written.append((key, old[0], state))
+        index.put(table, written)
+    db.commit()
+    db.close()
+
+
+WRITERS = {
+    'xlsx': save_xlsx,
+    'csv': save_csv,
+    'jsonl': save_jsonl,
+    'sqlite': save_sqlite,
+}
+
+APPENDERS = {
+    'csv': append_csv,
+    'jsonl': append_jsonl,
+    'sqlite': append_sqlite,
+}
+
+EXTENSIONS = {'.xlsx': 'xlsx', '.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl',
+              '.sqlite': 'sqlite', '.sqlite3': 'sqlite', '.db': 'sqlite'}
+
+
+def output_format(path, fmt=None):
+    """
+    Output format by explicit name or file extension
+    :param path: output file name
+    :param fmt: format name, one of WRITERS keys
+    :return: format name, 'xlsx' if extension is unknown
+    """
+    return fmt or EXTENSIONS.get(os.path.splitext(path)[1].lower(), 'xlsx')
+
+
+def save(oper, trf, path, fmt=None, group=None, extra=(), append=False):
+    """
+    Save operations and transfers
+    :param oper: list of operations
+    :param trf: list of transfers
+    :param path: output file name
+    :param fmt: format name, one of WRITERS keys, guessed by extension if none
+    :param group: None for single Operations table, 'bank' or 'card' for table per bank or card
+    :param extra: more tables (title, columns, rows) to write, e.g. analytics.summary_tables
+    :param append: write only rows that are not in the file yet and rows which transfer has changed
+            (see APPENDERS), xlsx is written in full
+    :return: None
+    """
+    fmt = output_format(path, fmt)
+    if append and fmt not in APPENDERS:
+        print("WARNING:", fmt, "can't be appended, the file is written in full")
+    (APPENDERS if append and fmt in APPENDERS else WRITERS)[fmt](oper, trf, path, group, extra)
+
+
+if __name__ == "__main__":
+    print("This module is for import only")